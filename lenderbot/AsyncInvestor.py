@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+import asyncio
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncInvestor:
+    """
+    Asyncio interface to an Investor. Each method mirrors the Investor method of the same name.
+    Requests run on a small thread pool so independent calls are in flight at the same time,
+    while the Investor's rate limiter still spaces out when each request is sent. A requests
+    Session isn't safe to share between threads, so each worker thread uses its own clone of the
+    Investor. Clones are made once per worker and share the Investor's connection pool, so keep
+    one AsyncInvestor around rather than making one per batch of calls.
+    """
+
+    def __init__(self, investor, max_workers=None):
+        self.investor = investor
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or investor.pool_size)
+        self.local = threading.local()
+        self.lock = threading.Lock()
+        self.clones = []
+
+    def close(self):
+        # The clones' connections belong to the Investor's pool, which the Investor closes
+        self.executor.shutdown(wait=True)
+
+    def _clone(self):
+        clone = getattr(self.local, 'investor', None)
+        if clone is None:
+            clone = self.local.investor = self.investor.clone()
+            with self.lock:
+                self.clones.append(clone)
+        return clone
+
+    def _run(self, name, args, kw):
+        # Runs on a worker thread
+        return getattr(self._clone(), name)(*args, **kw)
+
+    def _start(self, name, args, kw):
+        # Runs on a worker thread. A generator only sends its request once it's first advanced.
+        items = iter(self._run(name, args, kw))
+        for item in items:
+            return itertools.chain([item], items)
+        return iter(())
+
+    async def _call(self, name, *args, **kw):
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.executor, self._run, name, args, kw)
+
+    async def warm_connection(self):
+        """Open a connection to the API ahead of time so the next request skips the handshake."""
+        return await self._call('warm_connection')
+
+    async def get_loans(self, showAll=False):
+        """Retrieve currently listed loans."""
+        return await self._call('get_loans', showAll=showAll)
+
+    async def get_cash(self):
+        """Retrieve available cash balance."""
+        return await self._call('get_cash')
+
+    async def get_notes_owned(self):
+        """Retrieve basic information on currently owned notes."""
+        return await self._call('get_notes_owned')
+
+    async def get_detailed_notes_owned(self):
+        """Retrieve detailed information on currently owned notes."""
+        return await self._call('get_detailed_notes_owned')
+
+    async def iter_detailed_notes_owned(self):
+        """Retrieve detailed information on currently owned notes, one note at a time."""
+        loop = asyncio.get_event_loop()
+        notes = await loop.run_in_executor(self.executor, self._start, 'iter_detailed_notes_owned', (), {})
+        for note in notes:
+            yield note
+
+    async def stage_order(self, portfolio=None, cash=None):
+        """Resolve everything needed to place an order before any loans are known."""
+        return await self._call('stage_order', portfolio=portfolio, cash=cash)
+
+    async def submit_order(self, loans, portfolio=None, return_all=False):
+        """Place a note order."""
+        return await self._call('submit_order', loans, portfolio=portfolio, return_all=return_all)
+
+    async def submit_staged_order(self, staged, loans, return_all=False):
+        """Place a note order using a StagedOrder."""
+        return await self._call('submit_staged_order', staged, loans, return_all=return_all)
+
+    async def add_funds(self, amount):
+        """Initiate bank transfer to fund account."""
+        return await self._call('add_funds', amount)
+
+    async def get_pending_transfers(self):
+        """Retrieve information on current pending bank transfers."""
+        return await self._call('get_pending_transfers')
+
+    async def get_portfolios(self):
+        """Retrieve information on all portfolios."""
+        return await self._call('get_portfolios')
+
+    async def get_portfolio(self, name, create=False):
+        """Retrieve information on a specific portfolio, optionally creating it."""
+        return await self._call('get_portfolio', name, create=create)
+
+    async def create_portfolio(self, portfolio_name, portfolio_description=None):
+        """Create a portfolio."""
+        return await self._call('create_portfolio', portfolio_name, portfolio_description)
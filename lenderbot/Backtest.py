@@ -0,0 +1,242 @@
+#!/usr/bin/env python3
+
+"""
+Run the live filter set from filters.json against LendingClub history files.
+
+Filters are written against listing API field names ({inqLast6Mths}), so each
+rule is rewritten to the matching LoanStats CSV column ({inq_last_6mths})
+before it is compiled. Rows are evaluated in column batches, and every rule is
+evaluated exactly once per row. The result with each rule removed comes from
+ANDing prefix and suffix products of the per-rule masks, so no variant
+re-reads or re-evaluates anything.
+
+Some fields are encoded differently in the two sources (emp_length is text in
+history files and months in listings, for example). Rules on those fields
+need a declared column type or a history-specific rewrite.
+"""
+
+import itertools
+import logging
+import operator
+import re
+
+import numpy as np
+
+from lenderbot import lenderbot
+from lenderbot.ColumnFilter import LoanBatch, NUM
+from lenderbot.LoanFilter import BasicFilter, FilterSet
+from lenderbot.LoanHistory import LoanHistory
+
+# Listing API fields whose LoanStats column isn't just the snake_case name
+HISTORY_FIELDS = {
+    'loanAmount': 'loan_amnt',
+    'fundedAmount': 'funded_amnt',
+    'subGrade': 'sub_grade',
+    'isIncV': 'verification_status',
+    'delinq2Yrs': 'delinq_2yrs',
+    'inqLast6Mths': 'inq_last_6mths',
+    'mthsSinceLastDelinq': 'mths_since_last_delinq',
+    'mthsSinceLastRecord': 'mths_since_last_record',
+    'mthsSinceLastMajorDerog': 'mths_since_last_major_derog',
+    'accNowDelinq': 'acc_now_delinq',
+    'collections12MthsExMed': 'collections_12_mths_ex_med',
+    'numTl120dpd2m': 'num_tl_120dpd_2m',
+    'numTl30dpd': 'num_tl_30dpd',
+    'numTl90gDpd24m': 'num_tl_90g_dpd_24m',
+    'numTlOpPast12m': 'num_tl_op_past_12m',
+    'pctTlNvrDlq': 'pct_tl_nvr_dlq',
+    'percentBcGt75': 'percent_bc_gt_75',
+    'inqLast12m': 'inq_last_12m',
+    'openAcc6m': 'open_acc_6m',
+    'openIl12m': 'open_il_12m',
+    'openIl24m': 'open_il_24m',
+    'openRv12m': 'open_rv_12m',
+    'openRv24m': 'open_rv_24m',
+}
+
+DEFAULT_STATUS = 'Charged Off'
+
+
+def history_field(key):
+    """Return the LoanStats column holding a listing API field."""
+    if key in HISTORY_FIELDS:
+        return HISTORY_FIELDS[key]
+    return re.sub('([A-Z])', r'_\1', key).lower()
+
+
+def history_rule(rule):
+    """Rewrite the lookups of a filter rule to LoanStats column names."""
+    return re.sub(r'\{(\w+)\}', lambda match: '{%s}' % history_field(match.group(1)), rule)
+
+
+def _amounts(batch, *keys):
+    # The first of keys the batch holds, with anything non-numeric as 0
+    for key in keys:
+        if key in batch:
+            col = batch.column(key)
+            return np.where(col.kind == NUM, col.num, 0.0)
+    return None
+
+
+class Outcomes:
+    'Per-loan outcomes of one LoanBatch, extracted once and shared by every selection.'
+
+    def __init__(self, batch):
+        if 'loan_status' in batch:
+            self.default = batch.column('loan_status').text_compare(operator.eq, DEFAULT_STATUS)
+        else:
+            self.default = np.zeros(len(batch), dtype=bool)
+        self.funded = _amounts(batch, 'funded_amnt', 'loan_amnt')
+        self.paid = _amounts(batch, 'total_pymnt')
+        principal = _amounts(batch, 'total_rec_prncp')
+        # Principal lost to charged off loans. Without a principal column, count every payment as principal
+        repaid = principal if principal is not None else self.paid
+        if repaid is None:
+            repaid = 0
+        self.lost = np.where(self.default, np.maximum(self.funded - repaid, 0), 0) if self.funded is not None else None
+
+
+class Performance:
+    'Accumulated results of the loans one strategy would have bought.'
+
+    def __init__(self):
+        self.loans = 0
+        self.defaults = 0
+        self.funded = 0.0
+        self.paid = 0.0
+        self.lost = 0.0
+        self.has_amounts = False
+        self.has_payments = False
+
+    def add(self, outcomes, mask):
+        self.loans += int(mask.sum())
+        self.defaults += int(outcomes.default[mask].sum())
+        if outcomes.funded is not None:
+            self.has_amounts = True
+            self.funded += float(outcomes.funded[mask].sum())
+            self.lost += float(outcomes.lost[mask].sum())
+        if outcomes.paid is not None:
+            self.has_payments = True
+            self.paid += float(outcomes.paid[mask].sum())
+
+    def result(self):
+        """Return the results as a JSON serializable dict. Amounts are None if the history lacks them."""
+        realized = None
+        if self.has_amounts and self.has_payments and self.funded:
+            realized = (self.paid - self.funded) / self.funded
+        return {
+            'loans': self.loans,
+            'defaults': self.defaults,
+            'default_rate': self.defaults / self.loans if self.loans else 0.0,
+            'funded': self.funded if self.has_amounts else None,
+            'charged_off_principal': self.lost if self.has_amounts else None,
+            'realized_return': realized,
+        }
+
+
+class Backtest(LoanHistory):
+    """
+    A LoanHistory of the loans passing every rule, plus the performance of all history loans, of
+    the loans passing every rule and of the loans passing every rule but one.
+    """
+
+    def __init__(self, rules, files=[], cache=False, cacheDir=None, types=None, block=65536):
+        self.rules = list(rules)
+        self.block = block
+        self.history_filters = [BasicFilter(history_rule(rule)) for rule in self.rules]
+        self.unfiltered = Performance()
+        self.selected = Performance()
+        self.without = [Performance() for _ in self.rules]
+        self.rule_passed = [0] * len(self.rules)
+        # Rules reading a column the history doesn't have. They're reported, and pass every loan
+        self.skipped = set()
+        super(Backtest, self).__init__(FilterSet(self.history_filters, processes=1), files,
+                                       cache=cache, cacheDir=cacheDir, types=types)
+
+    def _parseFile(self, fn):
+        loans = self._readLoans(fn)
+        while True:
+            block = list(itertools.islice(loans, self.block))
+            if not block:
+                return True
+            self._parseBatch(LoanBatch(block))
+
+    def _mask(self, i, batch):
+        try:
+            return self.history_filters[i].mask(batch)
+        except KeyError as e:
+            if i not in self.skipped:
+                logging.getLogger(__name__).warning('Skipping %s: no %s column in the history', self.rules[i], e)
+                self.skipped.add(i)
+            return np.ones(len(batch), dtype=bool)
+
+    def _parseBatch(self, batch):
+        size = len(batch)
+        masks = [self._mask(i, batch) for i in range(len(self.rules))]
+
+        # prefix[i] passes rules [0, i), suffix[i] passes rules [i, n)
+        prefix = [np.ones(size, dtype=bool)]
+        for mask in masks:
+            prefix.append(prefix[-1] & mask)
+        suffix = [np.ones(size, dtype=bool)]
+        for mask in reversed(masks):
+            suffix.append(suffix[-1] & mask)
+        suffix.reverse()
+
+        outcomes = Outcomes(batch)
+        self.unfiltered.add(outcomes, prefix[0])
+        self.selected.add(outcomes, prefix[-1])
+        for i, mask in enumerate(masks):
+            self.rule_passed[i] += int(mask.sum())
+            self.without[i].add(outcomes, prefix[i] & suffix[i + 1])
+        self._gatherBatchStats(batch, prefix[-1])
+
+    def result(self):
+        """Return the backtest report as a JSON serializable dict."""
+        selected = self.selected.result()
+        marginal = []
+        for i, (rule, passed, without) in enumerate(zip(self.rules, self.rule_passed, self.without)):
+            without = without.result()
+            marginal.append({
+                'rule': rule,
+                'skipped': i in self.skipped,
+                'passed': passed,
+                'without': without,
+                # How much the rule lowers the default rate, and how many loans it costs
+                'default_rate_change': selected['default_rate'] - without['default_rate'],
+                'loans_removed': without['loans'] - selected['loans'],
+            })
+        return {
+            'files': list(self.Files),
+            'all': self.unfiltered.result(),
+            'selected': selected,
+            'rules': marginal,
+        }
+
+    def text(self):
+        res = self.result()
+
+        def describe(perf):
+            summary = '%d loan(s), %.2f%% charged off' % (perf['loans'], 100 * perf['default_rate'])
+            if perf['charged_off_principal'] is not None:
+                summary += ', $%.2f principal charged off' % (perf['charged_off_principal'])
+            if perf['realized_return'] is not None:
+                summary += ', %.2f%% realized return' % (100 * perf['realized_return'])
+            return summary
+
+        summary = 'All loans: %s\n' % (describe(res['all']))
+        summary += 'Passing filters: %s\n' % (describe(res['selected']))
+        for rule in res['rules']:
+            if rule['skipped']:
+                summary += '  Skipped %s: not in the history\n' % (rule['rule'])
+                continue
+            summary += '  Without %s: %s (%+.2f%% charged off)\n' % (rule['rule'], describe(rule['without']),
+                                                                    -100 * rule['default_rate_change'])
+        return summary
+
+
+def backtest(config_dir, files, cache=False, types=None):
+    """Backtest the filters in a configuration directory's filters.json."""
+    filters = lenderbot.lenderbot_init_filters(config_dir)
+    logging.getLogger(__name__).info('Backtesting %d filter(s) on %d file(s)', len(filters), len(files))
+    return Backtest([str(f) for f in filters.filters], files, cache=cache, types=types)
@@ -0,0 +1,288 @@
+#!/usr/bin/env python3
+
+"""
+Vectorized evaluation of compiled filter expressions.
+
+A LoanBatch holds loan fields as columns. Each Column keeps a per-row kind
+(None, number, string or error) alongside numeric and string arrays, so a
+compiled FilterParser tree can be evaluated for every loan in the batch with
+one NumPy operation per node. Results match evaluating the tree loan by loan:
+strings are converted as if written into the expression, string values compare
+as strings, and comparisons involving None or mismatched types fail.
+
+Only comparisons of lookups and constants are vectorized. Arithmetic can
+concatenate strings or raise on division by zero when evaluated loan by loan,
+so expressions using it aren't supported() and are evaluated loan by loan.
+Integer columns are kept as int64, so ids and other large integers compare
+exactly.
+"""
+
+import operator
+
+import numpy as np
+
+from lenderbot import FilterParser
+
+# Per-row value kinds
+NONE = 0
+NUM = 1
+STR = 2
+ERR = 3
+
+
+class Column(object):
+    """
+    A typed column of loan values.
+    Strings are either held as an array, or as integer codes into a vocabulary array whose
+    last entry is '' (code -1). Coded columns are compared through their vocabulary, and the
+    full array of strings is only built if `text` is read.
+    """
+
+    __slots__ = ('kind', 'num', '_text', 'codes', 'vocab')
+
+    def __init__(self, kind, num, text=None, codes=None, vocab=None):
+        self.kind = kind
+        self.num = num
+        # text, codes and vocab are None when the column holds no strings
+        self._text = text
+        self.codes = codes
+        self.vocab = vocab
+
+    def __len__(self):
+        return len(self.kind)
+
+    @property
+    def has_text(self):
+        return self._text is not None or self.codes is not None
+
+    @property
+    def text(self):
+        if self._text is None and self.codes is not None:
+            self._text = self.vocab[self.codes]
+        return self._text
+
+    def text_compare(self, fn, value):
+        """Return fn(string, value) for each row holding a string, and False for every other row."""
+        if not self.has_text:
+            return np.zeros(len(self), dtype=bool)
+        if self._text is None:
+            res = fn(self.vocab, value)[self.codes]
+        else:
+            res = fn(self._text, value)
+        return (self.kind == STR) & res
+
+    def text_counts(self, mask):
+        """Return the distinct strings of the rows selected by mask, sorted, and how many rows hold each."""
+        strings = self.kind[mask] == STR
+        if self._text is None and self.codes is not None:
+            counts = np.bincount(self.codes[mask][strings], minlength=len(self.vocab))
+            present = np.flatnonzero(counts)
+            order = np.argsort(self.vocab[present], kind='stable')
+            return self.vocab[present][order], counts[present][order]
+        if not self.has_text:
+            return np.array([], dtype=str), np.array([], dtype=np.int64)
+        return np.unique(self.text[mask][strings], return_counts=True)
+
+    @classmethod
+    def from_values(cls, values):
+        """Build a column from a list of raw loan values."""
+        n = len(values)
+        # Booleans read as the strings 'True' and 'False', like every other value written into a rule
+        if None not in values and not any(value.__class__ is bool for value in values):
+            # Fast path: every value is a number
+            try:
+                num = np.array(values)
+                if num.dtype.kind in 'iuf':
+                    return cls(np.full(n, NUM, dtype=np.int8), num.astype(np.int64 if num.dtype.kind != 'f' else float))
+            except (OverflowError, TypeError, ValueError):
+                pass
+
+        kind = np.empty(n, dtype=np.int8)
+        num = [0] * n
+        text = [''] * n
+        has_text = False
+        for i, value in enumerate(values):
+            value = FilterParser.substitute(value)
+            if value is None:
+                kind[i] = NONE
+            elif isinstance(value, str):
+                kind[i] = STR
+                text[i] = value
+                has_text = True
+            elif isinstance(value, (int, float)):
+                kind[i] = NUM
+                num[i] = value
+            else:
+                kind[i] = ERR
+        return cls(kind, _numbers(num), np.array(text) if has_text else None)
+
+    @classmethod
+    def from_scalar(cls, value):
+        return cls.from_values([value])
+
+    def take(self, indices):
+        if self._text is None and self.codes is not None:
+            return Column(self.kind[indices], self.num[indices], codes=self.codes[indices], vocab=self.vocab)
+        return Column(self.kind[indices], self.num[indices],
+                      self._text[indices] if self._text is not None else None)
+
+    def values(self):
+        """Return the column as a list of loan values. Rows holding neither a number nor a string are None."""
+        values = [None] * len(self)
+        num = self.num.tolist()
+        for i in np.flatnonzero(self.kind == NUM).tolist():
+            values[i] = num[i]
+        if self._text is None and self.codes is not None:
+            vocab = self.vocab.tolist()
+            codes = self.codes.tolist()
+            for i in np.flatnonzero(self.kind == STR).tolist():
+                values[i] = vocab[codes[i]]
+        elif self._text is not None:
+            for i in np.flatnonzero(self.kind == STR).tolist():
+                values[i] = str(self._text[i])
+        return values
+
+
+def _numbers(values):
+    # int64 when every number is an integer that fits, float64 otherwise
+    if all(type(value) is int for value in values):
+        try:
+            return np.array(values, dtype=np.int64)
+        except OverflowError:
+            pass
+    return np.array(values, dtype=float)
+
+
+class LoanBatch(object):
+    """
+    A batch of loans viewed as columns. Columns are built on first use, so only
+    the fields referenced by filters are ever extracted from the loans.
+    """
+
+    def __init__(self, loans=None, columns=None, size=None):
+        self.loans = loans if loans is not None else []
+        self.columns = dict(columns) if columns else {}
+        if size is None:
+            size = len(self.loans) if loans is not None else len(next(iter(self.columns.values()), []))
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, key):
+        if key in self.columns:
+            return True
+        return len(self.loans) > 0 and key in self.loans[0]
+
+    def keys(self):
+        """Return the fields the batch holds. Loans are assumed to share their fields."""
+        keys = list(self.columns)
+        if self.loans:
+            keys += [key for key in self.loans[0].keys() if key not in self.columns]
+        return keys
+
+    def take(self, indices):
+        """Return a new batch holding only the loans at the given positions."""
+        loans = [self.loans[i] for i in indices] if self.loans else None
+        columns = {key: col.take(indices) for key, col in self.columns.items()}
+        return LoanBatch(loans, columns, size=len(indices))
+
+    def column(self, key):
+        col = self.columns.get(key)
+        if col is None:
+            col = Column.from_values([loan[key] for loan in self.loans])
+            self.columns[key] = col
+        return col
+
+    def rows(self, keys):
+        """Return the loans, or if the batch only holds columns, a dict of `keys` per row."""
+        if self.loans or not self.columns and not len(self):
+            return self.loans
+        columns = [(key, self.column(key).values()) for key in keys]
+        return [dict((key, values[i]) for key, values in columns) for i in range(len(self))]
+
+
+_COMPARE = {
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+}
+
+
+def _strings(fn, a, b):
+    # fn over the strings of a and b. A column compared to a constant goes through the
+    # column's vocabulary when it has one, rather than through every row's string.
+    if len(b) == 1 and len(a) != 1:
+        return a.text_compare(fn, b.text[0])
+    if len(a) == 1 and len(b) != 1:
+        return b.text_compare(lambda x, y: fn(y, x), a.text[0])
+    return fn(a.text, b.text)
+
+
+def _equal(a, b):
+    res = (a.kind == NUM) & (b.kind == NUM) & (a.num == b.num)
+    both_str = (a.kind == STR) & (b.kind == STR)
+    if both_str.any():
+        res |= both_str & _strings(operator.eq, a, b)
+    res |= (a.kind == NONE) & (b.kind == NONE)
+    return res
+
+
+def _compare(op, a, b):
+    if op == '==':
+        return _equal(a, b)
+    if op == '!=':
+        return ~_equal(a, b) & (a.kind != ERR) & (b.kind != ERR)
+    fn = _COMPARE[op]
+    res = (a.kind == NUM) & (b.kind == NUM) & fn(a.num, b.num)
+    both_str = (a.kind == STR) & (b.kind == STR)
+    if both_str.any():
+        res |= both_str & _strings(fn, a, b)
+    return res
+
+
+def _truth(col):
+    res = (col.kind == NUM) & (col.num != 0)
+    if col.has_text:
+        res |= col.text_compare(operator.ne, '')
+    return res
+
+
+def _eval(node, batch):
+    if isinstance(node, FilterParser.EvalVariable):
+        return batch.column(node.key)
+    if isinstance(node, FilterParser.EvalConstant):
+        return Column.from_scalar(node.constant)
+    if isinstance(node, FilterParser.EvalSignOp):
+        # supported() only allows signs on numeric constants
+        return Column.from_scalar(node.eval({}))
+    if isinstance(node, FilterParser.EvalComparisonOp):
+        val1 = _eval(node.value[0], batch)
+        res = None
+        for op, val in FilterParser.operatorOperands(node.value[1:]):
+            val2 = _eval(val, batch)
+            step = _compare(op, val1, val2)
+            res = step if res is None else res & step
+            val1 = val2
+        return res
+    raise TypeError('Unsupported filter expression node: %r' % (node,))
+
+
+def supported(expr):
+    """Return whether evaluate() gives exactly the results of evaluating expr loan by loan."""
+    if isinstance(expr, (FilterParser.EvalVariable, FilterParser.EvalConstant)):
+        return True
+    if isinstance(expr, FilterParser.EvalSignOp):
+        return isinstance(expr.value, FilterParser.EvalConstant) and isinstance(expr.value.constant, (int, float))
+    if isinstance(expr, FilterParser.EvalComparisonOp):
+        return all(supported(val) for val in expr.value[::2])
+    return False
+
+
+def evaluate(expr, batch):
+    """Evaluate a compiled filter expression over a LoanBatch, returning a boolean mask."""
+    res = _eval(expr, batch)
+    if isinstance(res, Column):
+        res = _truth(res)
+    return np.broadcast_to(res, (len(batch),)).copy()
@@ -12,6 +12,8 @@ __version__ = '11.7.17'
 # Add // and % to multOp & EvalMultOp
 # Keep integer values as integers until something converts them
 # Allow longer var names
+# Add {key} lookups and Arith.compile so an expression can be parsed once
+#   and evaluated against many sets of vars
 
 # Based on:
 #
@@ -22,35 +24,59 @@ __version__ = '11.7.17'
 # Expansion on the pyparsing example simpleArith.py, to include evaluation
 # of the parsed tokens.
 
-from pyparsing import Word, nums, alphas, Combine, oneOf, Optional, \
-    opAssoc, operatorPrecedence, ParserElement
+from pyparsing import Word, nums, alphas, alphanums, Combine, oneOf, Optional, \
+    Suppress, opAssoc, operatorPrecedence, ParserElement
 ParserElement.enablePackrat() # Add memoization to parsing logic to increase performance
 
+def convert(value):
+    "Convert a string to an int, then a float, then None, falling back to the string itself"
+    try:
+        return int( value )
+    except:
+        pass
+    try:
+        return float( value )
+    except:
+        if value.lower() == "none":
+            return None
+        else:
+            return str( value )
+
 class EvalConstant():
     "Class to evaluate a parsed constant or variable"
     def __init__(self, tokens):
         self.value = tokens[0]
+        # Constants never change, so only convert them once
+        self.constant = convert( self.value )
+        # Bare names are only looked up in the vars_ of the Arith instance evaluating a string
+        # (see Arith.eval), never in the vars_ a compiled tree is evaluated with
+        self.names = None
     def eval(self, vars_):
-        if self.value in vars_:
-            return vars_[self.value]
+        if self.names is not None and self.value in self.names:
+            return self.names[self.value]
         else:
-            # Try to return an int, then a float, and finally a string
-            try:
-                return int( self.value )
-            except:
-                pass
-            try:
-                return float( self.value )
-            except:
-                if self.value.lower() == "none":
-                    return None
-                else:
-                    return str( self.value )
+            return self.constant
+
+def substitute(value):
+    "Return a {key} value as if its text had been written into the expression"
+    if isinstance(value, str):
+        return convert( value )
+    if isinstance(value, bool):
+        # str(True) parses as the bare name True, which is the string 'True'
+        return str( value )
+    return value
+
+class EvalVariable():
+    "Class to evaluate a {key} lookup into vars_"
+    def __init__(self, tokens):
+        self.key = tokens[0]
+    def eval(self, vars_):
+        return substitute( vars_[self.key] )
 
 class EvalSignOp():
     "Class to evaluate expressions with a leading + or - sign"
     def __init__(self, tokens):
-        self.sign, self.value = tokens[0]
+        self.sign, self.value = list( tokens[0] )
     def eval(self, vars_):
         mult = {'+':1, '-':-1}[self.sign]
         return mult * self.value.eval( vars_ )
@@ -69,7 +95,7 @@ def operatorOperands(tokenlist):
 class EvalMultOp():
     "Class to evaluate multiplication and division expressions"
     def __init__(self, tokens):
-        self.value = tokens[0]
+        self.value = list( tokens[0] )
     def eval(self, vars_ ):
         prod = self.value[0].eval( vars_ )
         for op,val in operatorOperands(self.value[1:]):
@@ -86,7 +112,7 @@ class EvalMultOp():
 class EvalAddOp():
     "Class to evaluate addition and subtraction expressions"
     def __init__(self, tokens):
-        self.value = tokens[0]
+        self.value = list( tokens[0] )
     def eval(self, vars_ ):
         sum = self.value[0].eval( vars_ )
         for op,val in operatorOperands(self.value[1:]):
@@ -107,7 +133,7 @@ class EvalComparisonOp():
         "!=" : lambda a,b : a != b,
         }
     def __init__(self, tokens):
-        self.value = tokens[0]
+        self.value = list( tokens[0] )
     def eval(self, vars_ ):
         val1 = self.value[0].eval( vars_ )
         try:
@@ -124,6 +150,31 @@ class EvalComparisonOp():
             return False
         return False
 
+def lookups(node):
+    "Return the set of var names a compiled expression may read from vars_"
+    if isinstance(node, EvalVariable):
+        return {node.key}
+    if isinstance(node, EvalConstant):
+        return set()
+    if isinstance(node, EvalSignOp):
+        return lookups(node.value)
+    names = set()
+    for val in node.value:
+        if not isinstance(val, str):
+            names |= lookups(val)
+    return names
+
+def constants(node):
+    "Yield every EvalConstant in a compiled expression"
+    if isinstance(node, EvalConstant):
+        yield node
+    elif isinstance(node, EvalSignOp):
+        yield from constants(node.value)
+    elif not isinstance(node, EvalVariable):
+        for val in node.value:
+            if not isinstance(val, str):
+                yield from constants(val)
+
 class Arith():
     # define the parser
     integer = Word(nums)
@@ -133,7 +184,9 @@ class Arith():
              )
 
     variable = Word(alphas+'_')
-    operand = real | integer | variable
+    constant = real | integer | variable
+    lookup = Combine(Suppress('{') + Word(alphanums+'_') + Suppress('}'))
+    operand = lookup | constant
 
     signop = oneOf('+ -')
     multop = oneOf('* / // %')
@@ -141,7 +194,8 @@ class Arith():
     comparisonop = oneOf("< <= > >= == != <>")
 
     # use parse actions to attach EvalXXX constructors to sub-expressions
-    operand.setParseAction(EvalConstant)
+    constant.setParseAction(EvalConstant)
+    lookup.setParseAction(EvalVariable)
     arith_expr = operatorPrecedence(operand,
         [(signop, 1, opAssoc.RIGHT, EvalSignOp),
          (multop, 2, opAssoc.LEFT, EvalMultOp),
@@ -158,8 +212,14 @@ class Arith():
     def setvar( var, val ):
         self.vars_[ var ] = val
 
+    def compile( self, strExpr ):
+        "Parse strExpr once. The returned tree can be evaluated repeatedly with tree.eval( vars_ )"
+        return self.arith_expr.parseString( strExpr, parseAll=True)[0]
+
     def eval( self, strExpr ):
-        ret = self.arith_expr.parseString( strExpr, parseAll=True)[0]
+        ret = self.compile( strExpr )
+        for node in constants( ret ):
+            node.names = self.vars_
         result = ret.eval( self.vars_ )
         return result
 
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+Columnar on-disk cache of parsed LendingClub history files.
+
+Sanitized loans are written once as one set of raw binary arrays per field:
+the per-row value kind and number, plus integer codes into a vocabulary for
+string values. Numbers are int64 for fields that only ever hold integers, so
+ids read back exactly, and float64 otherwise. Later runs memory-map the arrays instead of re-parsing the CSV,
+and keep strings as codes into the vocabulary until they're needed.
+A cache is only used while the source file's size and mtime are unchanged.
+"""
+
+import json
+import logging
+import os
+import shutil
+
+import numpy as np
+
+from lenderbot import ColumnFilter
+from lenderbot.ColumnFilter import Column, STR
+from lenderbot.Loan import Schema
+
+# Bump whenever the layout or the meaning of cached values changes
+CACHE_VERSION = 5
+
+
+class CachedBatch(ColumnFilter.LoanBatch):
+    'A LoanBatch whose columns are read from a HistoryCache the first time they are used.'
+
+    def __init__(self, cache, index=None):
+        super(CachedBatch, self).__init__(columns=None, size=cache.rows if index is None else len(index))
+        self.cache = cache
+        # Positions of this batch's rows in the cache, or None for every row
+        self.index = index
+
+    def __contains__(self, key):
+        return key in self.columns or key in self.cache.fields
+
+    def keys(self):
+        return list(self.cache.fields)
+
+    def take(self, indices):
+        index = indices if self.index is None else self.index[indices]
+        batch = CachedBatch(self.cache, index)
+        batch.columns = {key: col.take(indices) for key, col in self.columns.items()}
+        return batch
+
+    def column(self, key):
+        col = self.columns.get(key)
+        if col is None:
+            col = self.cache.column(key)
+            if self.index is not None:
+                col = col.take(self.index)
+            self.columns[key] = col
+        return col
+
+
+class HistoryCache:
+    """
+    The cache for a single history file, kept in a directory next to it (or under cache_dir).
+    `key` is anything JSON serializable that also changes how the file is parsed, such as declared column types.
+    """
+
+    def __init__(self, path, cache_dir=None, key=None):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        name = os.path.basename(path) + '.cache'
+        self.dir = os.path.join(cache_dir, name) if cache_dir else path + '.cache'
+        self.key = key
+        self.fields = []
+        # Number dtype of each field, 'int64' or 'float64'
+        self.dtypes = []
+        self.rows = 0
+
+    def _file(self, pos, part):
+        return os.path.join(self.dir, '%d.%s' % (pos, part))
+
+    def _source(self):
+        stat = os.stat(self.path)
+        return {'version': CACHE_VERSION, 'size': stat.st_size, 'mtime': stat.st_mtime, 'key': self.key}
+
+    def _meta(self):
+        try:
+            with open(os.path.join(self.dir, 'meta.json')) as handle:
+                return json.load(handle)
+        except (IOError, ValueError):
+            return None
+
+    def is_fresh(self):
+        meta = self._meta()
+        return meta is not None and meta['source'] == self._source()
+
+    def build(self, loans, block=65536):
+        """Write an iterable of sanitized loans to the cache, a block of rows at a time."""
+        source = self._source()
+        shutil.rmtree(self.dir, ignore_errors=True)
+        os.makedirs(self.dir)
+
+        fields = Schema()
+        vocabs = []
+        dtypes = []
+        rows = 0
+        pending = []
+        for loan in loans:
+            pending.append(loan)
+            if len(pending) >= block:
+                rows += self._write_block(pending, fields, vocabs, dtypes, rows)
+                pending = []
+        if pending:
+            rows += self._write_block(pending, fields, vocabs, dtypes, rows)
+
+        for pos, vocab in enumerate(vocabs):
+            if vocab:
+                with open(self._file(pos, 'vocab.json'), 'w') as handle:
+                    json.dump(sorted(vocab, key=vocab.get), handle)
+
+        # Written last. A cache without it is incomplete and gets rebuilt
+        with open(os.path.join(self.dir, 'meta.json'), 'w') as handle:
+            json.dump({'source': source, 'fields': fields.fields, 'dtypes': dtypes, 'rows': rows}, handle)
+        self.fields = fields.fields
+        self.dtypes = dtypes
+        self.rows = rows
+        self.logger.info('Cached %d loan(s) from %s', rows, self.path)
+
+    def _write_block(self, loans, fields, vocabs, dtypes, offset):
+        for loan in loans:
+            for key in loan.keys():
+                if key not in fields.index:
+                    pos = fields.add(key)
+                    vocabs.append({})
+                    dtypes.append('int64')
+                    if offset:
+                        # A field first seen part way through. Earlier rows don't hold it
+                        self._append(pos, Column.from_values([None] * offset), {}, dtypes)
+
+        for pos, key in enumerate(fields.fields):
+            self._append(pos, Column.from_values([loan.get(key) for loan in loans]), vocabs[pos], dtypes)
+        return len(loans)
+
+    def _append(self, pos, col, vocab, dtypes):
+        codes = np.full(len(col), -1, dtype=np.int32)
+        if col.has_text:
+            for i in np.flatnonzero(col.kind == STR):
+                codes[i] = vocab.setdefault(col.text[i], len(vocab))
+        num = col.num
+        if num.dtype.kind == 'f' and dtypes[pos] == 'int64':
+            # The first non-integer of the field. Widen what's been written so far
+            path = self._file(pos, 'num')
+            if os.path.exists(path):
+                np.fromfile(path, dtype=np.int64).astype(float).tofile(path)
+            dtypes[pos] = 'float64'
+        num = num.astype(dtypes[pos])
+        for part, values in (('kind', col.kind), ('num', num), ('codes', codes)):
+            with open(self._file(pos, part), 'ab') as handle:
+                values.tofile(handle)
+
+    def load(self):
+        """Open the cache, returning a CachedBatch over every row, or None if it is missing or stale."""
+        meta = self._meta()
+        if meta is None or meta['source'] != self._source():
+            return None
+        self.fields = meta['fields']
+        self.dtypes = meta['dtypes']
+        self.rows = meta['rows']
+        return CachedBatch(self)
+
+    def column(self, key):
+        """Memory-map a single cached field as a Column."""
+        pos = self.fields.index(key) if key in self.fields else None
+        if pos is None:
+            raise KeyError(key)
+        if not self.rows:
+            return Column.from_values([])
+        kind = np.memmap(self._file(pos, 'kind'), dtype=np.int8, mode='r')
+        num = np.memmap(self._file(pos, 'num'), dtype=self.dtypes[pos], mode='r')
+        if not os.path.exists(self._file(pos, 'vocab.json')):
+            return Column(kind, num)
+        with open(self._file(pos, 'vocab.json')) as handle:
+            # Code -1 (not a string) picks the trailing ''
+            vocab = np.array(json.load(handle) + [''])
+        return Column(kind, num, codes=np.memmap(self._file(pos, 'codes'), dtype=np.int32, mode='r'), vocab=vocab)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+
+"""
+Column types for LendingClub history files.
+
+Every column of a history CSV gets one type, declared or inferred from the
+header and a sample of rows. Each value is converted once, while the file is
+read, so filters compare numbers as numbers and rows don't need per-value
+cleanup afterwards.
+
+    int          '36'         -> 36
+    float        '12.50'      -> 12.5
+    percent      ' 13.5%'     -> 13.5
+    months       ' 36 months' -> 36
+    date         'Dec-2015'   -> month ordinal (see Loan.month_ordinal)
+    categorical  'Charged Off' (interned)
+    text         'Bought a car'
+
+Inferred string columns are categorical when they hold a limited set of values,
+and text otherwise. Only categorical values are interned, since interning free text costs
+a lookup per value and saves nothing.
+
+Empty cells become 0 in numeric columns and None in date, categorical and text ones.
+A value that doesn't convert is left as it was read.
+"""
+
+import csv
+import itertools
+import re
+import sys
+
+from lenderbot.Loan import month_ordinal
+
+_DATE = re.compile(r'^[A-Z][a-z]{2}-\d{4}$')
+_MONTHS = re.compile(r'^\s*(\d+) months?\s*$')
+
+
+def _percent(value):
+    return float(value.strip().rstrip('%'))
+
+
+def _months(value):
+    match = _MONTHS.match(value)
+    if not match:
+        raise ValueError(value)
+    return int(match.group(1))
+
+
+def _date(value):
+    value = value.strip()
+    if not _DATE.match(value):
+        raise ValueError(value)
+    return month_ordinal(value)
+
+
+# Checked in order during inference. The first converter that accepts every sampled value wins.
+CONVERTERS = [
+    ('int', int),
+    ('float', float),
+    ('percent', _percent),
+    ('months', _months),
+    ('date', _date),
+    ('categorical', sys.intern),
+    ('text', str),
+]
+
+EMPTY = {'int': 0, 'float': 0, 'percent': 0, 'months': 0, 'date': None, 'categorical': None, 'text': None}
+
+# A sampled string column with more distinct values than this is text
+CATEGORICAL_MAX = 100
+
+
+def _accepts(convert, values):
+    try:
+        for value in values:
+            convert(value)
+    except ValueError:
+        return False
+    return True
+
+
+class HistorySchema:
+    'A type per history column.'
+
+    def __init__(self, types):
+        converters = dict(CONVERTERS)
+        for field, kind in types.items():
+            if kind not in converters:
+                raise ValueError('Unknown column type %r for %s' % (kind, field))
+        self.types = dict(types)
+        self._converters = [(field, converters[kind], EMPTY[kind]) for field, kind in self.types.items()]
+
+    def __getstate__(self):
+        return self.types
+
+    def __setstate__(self, types):
+        self.__init__(types)
+
+    @classmethod
+    def infer(cls, fieldnames, rows, declared=None):
+        """Pick a type for each field from sample rows. Declared types take precedence."""
+        declared = declared or {}
+        types = {}
+        for field in fieldnames:
+            if field in declared:
+                types[field] = declared[field]
+                continue
+            values = [row[field] for row in rows if isinstance(row.get(field), str) and row[field].strip()]
+            kind = next(kind for kind, convert in CONVERTERS if _accepts(convert, values))
+            if kind == 'categorical' and len(set(values)) > CATEGORICAL_MAX:
+                kind = 'text'
+            types[field] = kind
+        return cls(types)
+
+    @classmethod
+    def sample(cls, path, declared=None, count=1000):
+        """Infer the schema of a CSV file from its first `count` rows."""
+        with open(path, 'r') as csvfile:
+            reader = csv.DictReader(csvfile)
+            rows = list(itertools.islice(reader, count))
+            return cls.infer(reader.fieldnames or [], rows, declared)
+
+    def convert(self, row):
+        """Convert the values of a row dict in place."""
+        for field, convert, empty in self._converters:
+            value = row.get(field)
+            if not isinstance(value, str):
+                continue
+            if not value.strip():
+                row[field] = empty
+                continue
+            try:
+                row[field] = convert(value)
+            except ValueError:
+                pass
+        return row
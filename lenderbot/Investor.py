@@ -1,61 +1,104 @@
 #!/usr/bin/env python3
 
-import datetime
+import copy
 import json
 import logging
 import time
 
 import requests
+from requests.adapters import HTTPAdapter
 
 from lenderbot import Loan
+from lenderbot.RateLimiter import TokenBucket
+
+
+class StagedOrder:
+    """
+    An order prepared ahead of a listing drop. The portfolio, invest amount and number of notes
+    we can afford are resolved up front, and the JSON payload is a template that only needs the
+    loan IDs filled in.
+    """
+
+    def __init__(self, iid, invest_amt, portfolio_id=None, cash=None):
+        self.iid = iid
+        self.invest_amt = invest_amt
+        self.portfolio_id = portfolio_id
+        self.remaining = int(cash // invest_amt) if cash is not None else None
+        self.url = 'accounts/%s/orders' % (iid)
+
+        # Pre-render everything but the loan ID
+        loan_fields = '"requestedAmount": %s' % (json.dumps(invest_amt))
+        if portfolio_id:
+            loan_fields += ', "portfolioId": %s' % (json.dumps(portfolio_id))
+        self.loan_template = '{"loanId": %s, ' + loan_fields.replace('%', '%%') + '}'
+        self.payload_prefix = '{"aid": %s, "orders": [' % (json.dumps(iid))
+        self.payload_suffix = ']}'
+
+    def select(self, loans):
+        """Return as many of loans as we can afford."""
+        if self.remaining is None:
+            return loans
+        return loans[:max(self.remaining, 0)]
+
+    def payload(self, loans):
+        return self.payload_prefix + \
+            ', '.join([self.loan_template % (json.dumps(loan['id'])) for loan in loans]) + \
+            self.payload_suffix
 
 
 class Investor:
     """A simple class to interact with your LendingClub account."""
 
-    def __init__(self, iid, auth_key, invest_amt=25, production_mode=False):
+    def __init__(self, iid, auth_key, invest_amt=25, production_mode=False, pool_size=4, rate=1.0, burst=4,
+                 endpoint_root='https://api.lendingclub.com/api/investor/v1/'):
         self.iid = iid
         self.headers = {'Authorization': auth_key, 'Accept': 'application/json', 'Content-type': 'application/json'}
-        self.endpoint_root = 'https://api.lendingclub.com/api/investor/v1/'
+        self.endpoint_root = endpoint_root
+        self.pool_size = pool_size
+        # Reuse connections across requests to avoid a TCP connect and TLS handshake per call
+        self.session = self._new_session()
         self.invest_amt = invest_amt
         self.production_mode = production_mode
         self.logger = logging.getLogger(__name__)
-        self.time_delay = datetime.timedelta(seconds=1)  # We must wait one second between requests
-        self.last_request_ts = datetime.datetime.min  # No requests have been made yet
+        self.limiter = TokenBucket(rate=rate, burst=burst)  # Every request shares the API rate limit
         self.max_log_len = 1024
+        self.listing_ts = None  # When the most recent listing was received
         self.filters = []
-        self.my_note_ids = [x['loanId'] for x in self.get_notes_owned()]
 
-    def __set_ts(self):
-        self.last_request_ts = datetime.datetime.now()
-        return
+    def _new_session(self, adapter=None):
+        session = requests.Session()
+        session.headers.update(self.headers)
+        session.mount(self.endpoint_root, adapter or HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size))
+        return session
 
-    def __get_ts(self):
-        return self.last_request_ts
+    def clone(self):
+        """
+        Return a copy of this Investor with its own session. The copy shares the rate limiter, so
+        requests from both still count against the same API limit, and the connection pool, so
+        connections opened by either one are reused by the other. Only close the original.
+        """
+        investor = copy.copy(self)
+        investor.session = investor._new_session(self.session.get_adapter(self.endpoint_root))
+        return investor
 
     def __execute_delay(self):
-        cur_time = datetime.datetime.now()
-        delta = cur_time - self.__get_ts()
-        if delta < self.time_delay:
-            # Round up sleep time to the nearest second
-            sleep_time = (delta + datetime.timedelta(milliseconds=999)).seconds
-            time.sleep(sleep_time)
+        self.limiter.acquire()
         return
 
     def __execute_get(self, url, log=True):
         self.__execute_delay()
         endpoint = self.endpoint_root + url
-        response = requests.get(endpoint, headers=self.headers)
-        self.__set_ts()
-        if log and len(response.text) < self.max_log_len:
+        response = self.session.get(endpoint)
+        if log and len(response.content) < self.max_log_len:
             self.logger.debug('-------- GET BEGIN --------')
             self.logger.debug('Endpoint: %s', endpoint)
             self.logger.debug('Headers:  %s', self.headers)
             self.logger.debug('Response: %s | %s', response, response.text)
             self.logger.debug('--------- GET END ---------')
         try:
-            # We expect a valid JSON response
-            return json.loads(str(response.text))
+            # We expect a valid JSON response. json detects the encoding of the raw bytes itself,
+            # so there's no need to build (and guess the encoding of) an intermediate string.
+            return json.loads(response.content)
         except:
             # We received a garbage response. Log error and return None
             self.logger.warning('Get failed. Response text: \'%s\'', response.text)
@@ -64,9 +107,8 @@ class Investor:
     def __execute_post(self, url, payload=None, log=True):
         self.__execute_delay()
         endpoint = self.endpoint_root + url
-        response = requests.post(endpoint, data=payload, headers=self.headers)
-        self.__set_ts()
-        if log and len(response.text) < self.max_log_len:
+        response = self.session.post(endpoint, data=payload)
+        if log and len(response.content) < self.max_log_len:
             self.logger.debug('-------- POST BEGIN --------')
             self.logger.debug('Endpoint: %s', endpoint)
             self.logger.debug('Data:     %s', payload)
@@ -75,15 +117,29 @@ class Investor:
             self.logger.debug('--------- POST END ---------')
         try:
             # We expect a valid JSON response
-            return json.loads(response.text)
+            return json.loads(response.content)
         except:
             # We received a garbage response. Log error and return None
             self.logger.warning('Post failed. Response text: \'%s\'', response.text)
             return None
 
+    def warm_connection(self):
+        """Open a connection to the API ahead of time so the next request skips the handshake."""
+        self.__execute_delay()
+        try:
+            self.session.head(self.endpoint_root)
+        except requests.RequestException as e:
+            self.logger.warning('Unable to warm API connection: %s', e)
+
+    def close(self):
+        """Close any pooled connections."""
+        self.session.close()
+
     def get_loans(self, showAll=False):
+        """Retrieve currently listed loans."""
         loans = []
         listings = self.__execute_get('loans/listing?showAll=%s' % (showAll))
+        self.listing_ts = time.monotonic()
         if listings is not None and 'loans' in listings:
             raw_loans = listings['loans']
             loans = [Loan.InFundingLoan(raw_loan) for raw_loan in raw_loans]
@@ -107,35 +163,53 @@ class Investor:
 
     def get_detailed_notes_owned(self):
         """Retrieve detailed information on currently owned notes."""
+        return list(self.iter_detailed_notes_owned())
+
+    def iter_detailed_notes_owned(self):
+        """Retrieve detailed information on currently owned notes, one note at a time."""
         mynotes = self.__execute_get('accounts/%s/detailednotes' % (self.iid))
         try:
-            return [Loan.DetailedOwnedNote(raw_loan) for raw_loan in mynotes['myNotes']]
+            raw_notes = mynotes['myNotes']
         except (TypeError, KeyError):
-            return []
+            return
+        for raw_loan in raw_notes:
+            yield Loan.DetailedOwnedNote(raw_loan)
+
+    def stage_order(self, portfolio=None, cash=None):
+        """
+        Resolve everything needed to place an order before any loans are known.
+        If cash is given, orders placed with the staged order never exceed it.
+        """
+        # Portfolio parameter can either be a dictionary or portfolio ID
+        portfolio_id = None
+        if isinstance(portfolio, dict):
+            portfolio_id = portfolio['portfolioId']
+        elif isinstance(portfolio, str):
+            portfolio_id = portfolio
+        elif portfolio is not None:
+            self.logger.error('Invalid portfolio type passed to stage_order()')
+        return StagedOrder(self.iid, self.invest_amt, portfolio_id, cash)
 
     def submit_order(self, loans, portfolio=None, return_all=False):
         """Place a note order. Default behavior will return the execution status for successfully ordered notes."""
+        return self.submit_staged_order(self.stage_order(portfolio), loans, return_all)
+
+    def submit_staged_order(self, staged, loans, return_all=False):
+        """Place a note order using a StagedOrder. Returns execution statuses like submit_order()."""
         if self.production_mode:
-            # Portfolio parameter can either be a dictionary or portfolio ID
-            portfolio_id = None
-            if isinstance(portfolio, dict):
-                portfolio_id = portfolio['portfolioId']
-            elif isinstance(portfolio, str):
-                portfolio_id = portfolio
-            elif portfolio is not None:
-                self.logger.error('Invalid portfolio type passed to submit_order()')
-
-            # Construction order payload
             if not isinstance(loans, list):
                 loans = [loans]
-            loan_dict = [{'loanId': loan['id'], 'requestedAmount': self.invest_amt} for loan in loans]
-            if portfolio_id:
-                for loan in loan_dict:
-                    loan.update({'portfolioId': portfolio_id})
-            order = json.dumps({"aid": self.iid, "orders": loan_dict})
+            loans = staged.select(loans)
+            if not loans:
+                return []
 
             # Place order and return the order execution status
-            order_status = self.__execute_post('accounts/%s/orders' % (self.iid), payload=order)
+            order = staged.payload(loans)
+            if self.listing_ts is not None:
+                self.logger.info('Sending order %.3f second(s) after listing was received', time.monotonic() - self.listing_ts)
+            order_status = self.__execute_post(staged.url, payload=order)
+            if self.listing_ts is not None:
+                self.logger.info('Order confirmed %.3f second(s) after listing was received', time.monotonic() - self.listing_ts)
             try:
                 # An execution status for each note is listed under the 'orderConfirmations' key.
                 # Each execution status contains a list of attributes about how the order was (or
@@ -150,10 +224,13 @@ class Investor:
                        'ERROR_ADDING_NOTE_TO_PORTFOLIO'
                 ]
                 c = order_status['orderConfirmations']
+                success = [es for es in c if set(es['executionStatus']).intersection(success_status)]
+                if staged.remaining is not None:
+                    staged.remaining -= len(success)
                 if return_all:
                     return c
                 else:
-                    return [es for es in c if set(es['executionStatus']).intersection(success_status)]
+                    return success
             except (TypeError, KeyError):
                 return []
         else:
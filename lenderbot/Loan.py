@@ -1,33 +1,175 @@
 #!/usr/bin/env python3
 
-import re
 import sys
 import logging
-from datetime import datetime, timedelta
-from calendar import monthrange
+from datetime import datetime
+from functools import lru_cache
 
+import numpy as np
 
-class Loan(dict):
+
+class _Missing(object):
+    'Marks a schema field that a record does not hold.'
+
+    def __repr__(self):
+        return '<missing>'
+
+
+_MISSING = _Missing()
+
+
+class Schema(object):
+    """
+    Field names shared by many records, mapped to positions in each record's value list.
+    Schemas only grow. A record whose value list is shorter than its schema simply doesn't
+    hold the trailing fields.
+    """
+
+    __slots__ = ('fields', 'index')
+
+    # Schemas are shared by every record built from the same keys
+    _registry = {}
+
+    def __init__(self, fields=()):
+        self.fields = []
+        self.index = {}
+        for field in fields:
+            self.add(field)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def add(self, field):
+        """Return the position of field, appending it to the schema if necessary."""
+        pos = self.index.get(field)
+        if pos is None:
+            pos = len(self.fields)
+            self.fields.append(field)
+            self.index[field] = pos
+        return pos
+
+    @classmethod
+    def for_fields(cls, fields):
+        """Return the shared schema for a tuple of field names."""
+        schema = cls._registry.get(fields)
+        if schema is None:
+            schema = cls._registry[fields] = cls(fields)
+        return schema
+
+
+@lru_cache(maxsize=None)
+def month_ordinal(date):
+    """Return a count of months for a date of the form 'Dec-2015'. A dataset only has a few hundred."""
+    parsed = datetime.strptime(date, '%b-%Y')
+    return parsed.year * 12 + parsed.month - 1
+
+
+def month_ordinals(dates):
+    """Vectorized month_ordinal(). Dates already typed as month ordinals are returned as they are."""
+    dates = np.asarray(dates)
+    if dates.dtype.kind in 'iuf':
+        return dates.astype(np.int64)
+    # Each distinct date string is parsed once
+    unique, inverse = np.unique(dates.astype(str), return_inverse=True)
+    return np.array([month_ordinal(date) for date in unique], dtype=np.int64)[inverse]
+
+
+def loan_ages(issued, last_paid):
+    """Vectorized PastLoan.getAge(): whole months from each issue date to the matching last payment date."""
+    return np.maximum(month_ordinals(last_paid) - month_ordinals(issued), 0)
+
+
+class Loan(object):
     """
     A simple class to represent a LendingClub loan.
     This is a wrapper implementing comparison methods to allow sorting.
+
+    Loans behave like read/write dicts, but store their values in a list laid out by a Schema
+    shared with every loan that has the same fields, so each loan only costs a list of values.
     """
 
+    __slots__ = ('_schema', '_values', 'quality')
+
     def __init__(self, *args, **kw):
-        super(Loan, self).__init__(*args, **kw)
+        if len(args) == 1 and not kw and isinstance(args[0], dict):
+            data = args[0]
+        else:
+            data = dict(*args, **kw)
+        self._schema = Schema.for_fields(tuple(data))
+        self._values = list(data.values())
         self.quality = 100
 
+    def __getstate__(self):
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                if hasattr(self, name):
+                    state[name] = getattr(self, name)
+        return state
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            object.__setattr__(self, name, value)
+
+    def __missing__(self, key):
+        raise KeyError(key)
+
+    def __getitem__(self, key):
+        if key == 'quality':
+            return self.quality
+        pos = self._schema.index.get(key)
+        if pos is not None and pos < len(self._values):
+            value = self._values[pos]
+            if value is not _MISSING:
+                return value
+        return self.__missing__(key)
+
     def __setitem__(self, key, value):
         if key == 'quality':
             self.quality = value
-        else:
-            super(Loan, self).__setitem__(key, value)
+            return
+        pos = self._schema.add(key)
+        values = self._values
+        if pos >= len(values):
+            values.extend([_MISSING] * (pos + 1 - len(values)))
+        values[pos] = value
         return
 
-    def __getitem__(self, key):
-        if key == 'quality':
-            return self.quality
-        return super(Loan, self).__getitem__(key)
+    def __contains__(self, key):
+        pos = self._schema.index.get(key)
+        return pos is not None and pos < len(self._values) and self._values[pos] is not _MISSING
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def items(self):
+        fields = self._schema.fields
+        return [(fields[i], v) for i, v in enumerate(self._values) if v is not _MISSING]
+
+    def keys(self):
+        return [k for k, _ in self.items()]
+
+    def values(self):
+        return [v for v in self._values if v is not _MISSING]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return sum(1 for v in self._values if v is not _MISSING)
+
+    def update(self, *args, **kw):
+        for k, v in dict(*args, **kw).items():
+            self[k] = v
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __repr__(self):
+        return repr(self.to_dict())
 
     def __lt__(self, other):
         return self.quality < other.quality
@@ -38,7 +180,7 @@ class Loan(dict):
     def __eq__(self, other):
         return self.quality == other.quality
 
-    def __nq__(self, other):
+    def __ne__(self, other):
         return self.quality != other.quality
 
     def __gt__(self, other):
@@ -47,6 +189,8 @@ class Loan(dict):
     def __ge__(self, other):
         return self.quality >= other.quality
 
+    __hash__ = None
+
     def set_quality(self, quality):
         self.quality = quality
 
@@ -54,6 +198,8 @@ class Loan(dict):
 class InFundingLoan(Loan):
     'Implement string representation for In Funding Loans'
 
+    __slots__ = ()
+
     def __repr__(self):
         # Print some of the more interesting loan details
         str = ''
@@ -70,6 +216,8 @@ class InFundingLoan(Loan):
 class OwnedNote(Loan):
     'Implement string representation for Owned Notes'
 
+    __slots__ = ()
+
     def __repr__(self):
         # Print some of the more interesting note details
         str = ''
@@ -83,6 +231,8 @@ class OwnedNote(Loan):
 class DetailedOwnedNote(Loan):
     'Implement string representation for Detailed Owned Notes'
 
+    __slots__ = ()
+
     def __repr__(self):
         # Print some of the more interesting note details
         str = ''
@@ -119,6 +269,8 @@ class DetailedOwnedNote(Loan):
 class PastLoan(Loan):
     'A simple class to represent a historical LendingClub loan.'
 
+    __slots__ = ('_valid',)
+
     def __init__(self, badKey, badVal, *args, **kw):
         super(PastLoan, self).__init__(*args, **kw)
 
@@ -132,23 +284,15 @@ class PastLoan(Loan):
             self['loan_age'] = self._calcAge()
         return self['loan_age']
 
-    def _calcAge(self):
-        # Expects dates to be of the form 'Dec-2015'
-        start = datetime.strptime(str(self['issue_d']), '%b-%Y')
-        end = datetime.strptime(str(self['last_pymnt_d']), '%b-%Y')
+    @staticmethod
+    def _months(date):
+        # Dates are month ordinals once typed by a HistorySchema
+        return date if isinstance(date, int) else month_ordinal(str(date))
 
+    def _calcAge(self):
         # Count the months between issue date and last payment
-        months = 0
-        while (start < end):
-            # Get number of days of start's current month
-            mdays = monthrange(start.year, start.month)[1]
-            start += timedelta(days=mdays)
-
-            # If end >= (start + start.month[days]), count this month
-            if end >= start:
-                months += 1
-
-        return months
+        months = self._months(self['last_pymnt_d']) - self._months(self['issue_d'])
+        return max(months, 0)
 
     def _sanitize(self, badKey, badVal):
         valid = True
@@ -163,7 +307,8 @@ class PastLoan(Loan):
             logging.debug("Bad Key")
             valid = False
 
-        if 'last_pymnt_d' in self and re.match("^\s*$", self['last_pymnt_d']):
+        last_pymnt_d = self.get('last_pymnt_d')
+        if 'last_pymnt_d' in self and (last_pymnt_d is None or not str(last_pymnt_d).strip()):
             if 'issue_d' in self:
                 # If no payment received, last payment date = issue date
                 self['last_pymnt_d'] = self['issue_d']
@@ -174,8 +319,8 @@ class PastLoan(Loan):
                 valid = False
                 break
 
-            # Replace empties with 0s
-            if re.match('^\s*$', str(v)):
+            # Replace empties with 0s. Rows typed by a HistorySchema have none left
+            if isinstance(v, str) and not v.strip():
                 self[k] = 0
 
         if not valid:
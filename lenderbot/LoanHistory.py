@@ -3,21 +3,132 @@
 import sys
 import getopt
 import os
+import locale
 import logging
 import csv
+import itertools
+import json
+import operator
 import re
+from multiprocessing import Pool
+
+import numpy as np
+
+from lenderbot.ColumnFilter import NUM, STR
+from lenderbot.HistoryCache import HistoryCache
+from lenderbot.HistorySchema import HistorySchema
+from lenderbot.Loan import PastLoan, loan_ages, month_ordinals
+from lenderbot.LoanFilter import BasicFilter, FilterSet
+from lenderbot.Sketch import Profile
+
+# Encoding used to decode CSV files read in binary mode. Matches open(f, 'r').
+ENCODING = locale.getpreferredencoding(False)
+
+
+def _countQuotes(fh, start, end, blockSize=1<<22):
+   fh.seek(start)
+   count = 0
+   while start < end:
+      block = fh.read(min(blockSize, end - start))
+      if not block:
+         break
+      count += block.count(b'"')
+      start += len(block)
+   return count
+
+
+def _splitFile(path, chunkBytes=None):
+   """
+   Split a CSV file into byte ranges that each start on a row boundary.
+   Boundaries are found by tracking quote parity, so quoted fields spanning lines stay whole.
+   Returns the header and a list of (start, end) ranges.
+   """
+   size = os.path.getsize(path)
+   with open(path, 'rb') as fh:
+      header = next(csv.reader([fh.readline().decode(ENCODING)]))
+      starts = [fh.tell()]
+      if chunkBytes:
+         parity = 0
+         pos = starts[0]
+         target = pos + chunkBytes
+         while target < size:
+            parity ^= _countQuotes(fh, pos, target) & 1
+            pos = target
+            fh.seek(pos)
+            # Finish the current line, and keep going until we're not inside a quoted field
+            for line in iter(fh.readline, b''):
+               parity ^= line.count(b'"') & 1
+               pos += len(line)
+               if parity == 0:
+                  break
+            if pos >= size:
+               break
+            starts.append(pos)
+            target = pos + chunkBytes
+   return header, list(zip(starts, starts[1:] + [size]))
+
+
+def _rangeLines(fh, start, end):
+   fh.seek(start)
+   pos = start
+   while pos < end:
+      line = fh.readline()
+      if not line:
+         break
+      pos += len(line)
+      yield line.decode(ENCODING)
+
+
+def _ingestRange(task):
+   """Pool worker: parse, sanitize, filter and count one byte range of a file."""
+   loanFilt, path, header, start, end, keepLoans, schema, stereoColumns = task
+   # The parent pool is doing the parallel work. Filter in-process.
+   loanFilt.processes = 1
+   history = LoanHistory(loanFilt, keepLoans=keepLoans, stereoColumns=stereoColumns)
+   history._parseRange(path, header, start, end, schema)
+   return history.Counts, history.Loans, history.Profile
+
+
+def _dates(col, mask):
+   # Typed dates are month ordinals. Untyped ones, and any value that didn't convert, are still
+   # 'Dec-2015' strings. Rows holding neither count as month 0.
+   col = col.take(mask)
+   dates = np.where(col.kind == NUM, col.num, 0).astype(np.int64)
+   strings = col.kind == STR
+   if strings.any():
+      dates[strings] = month_ordinals(col.text[strings])
+   return dates
 
-from Loan import PastLoan
-from LoanFilter import BasicFilter
 
 class LoanHistory(object):
-   def __init__(self, loanFilt, files=[]):
+   def __init__(self, loanFilt, files=[], keepLoans=False, processes=1, chunkBytes=None, cache=False, cacheDir=None, types=None, stereoColumns=[]):
       self.Filt = loanFilt
-      # Group loans to reduce search space at the expense of storage when groupings are not exclusive
+      # Column types that override the ones inferred from each file
+      self.Types = types or {}
+      # Loans that passed the filter, counted by age. Only the counts are needed for default rates.
+      self.Counts = {'default' : {},
+                     'good'    : {}}
+      # Full loan records, grouped the same way, are only kept when requested
+      self.keepLoans = keepLoans
       self.Loans = {'default' : {},
                     'good'    : {}}
+      # Streaming summaries of the columns of loans that passed the filter, for stereoType(). Off by
+      # default. Pass the columns to summarize, or None for every column.
+      self.stereoColumns = stereoColumns
+      self.Profile = Profile(columns=stereoColumns)
 
       self.Files = files
+      # Cached files hold columns, not loans, so they can't be used to keep loans
+      if cache and not keepLoans:
+         for f in self.Files:
+            if os.path.isfile(f):
+               self._parseCached(f, cacheDir)
+         return
+
+      if processes > 1:
+         self._parseParallel(processes, chunkBytes)
+         return
+
       for f in self.Files:
          if os.path.isfile(f):
             logging.info("Gathering Stats on {}".format(f))
@@ -33,129 +144,279 @@ class LoanHistory(object):
 
 
    def _parseFile(self, fn):
+      # Rows stream through read -> sanitize -> filter -> aggregate. The filter set's worker
+      # pool only reads a bounded number of chunks ahead, so nothing holds the whole file.
+      for loan,passed in self.Filt.imap(self._readLoans(fn)):
+         if passed == True:
+            self._gatherDefaultStats(loan)
+            self._gatherStereotypeStats(loan)
+
+      return True
+
+
+   def _parseRange(self, path, header, start, end, schema):
+      with open(path, 'rb') as fh:
+         for loan,passed in self.Filt.imap(self._readLoans(_rangeLines(fh, start, end), header, schema)):
+            if passed == True:
+               self._gatherDefaultStats(loan)
+               self._gatherStereotypeStats(loan)
+
+
+   # Filter a memory-mapped columnar copy of the file, building it first if it's missing or stale
+   def _parseCached(self, f, cacheDir):
+      batch = self.loadCached(f, cacheDir)
+      logging.info("Gathering Stats on {}".format(f))
+      self._parseBatch(batch)
+
+
+   # Return a memory-mapped LoanBatch of a file's columns, typed with this history's column types.
+   # The columnar cache is built first if it's missing or stale.
+   def loadCached(self, f, cacheDir=None):
+      cache = HistoryCache(f, cacheDir, key=self.Types or None)
+      batch = cache.load()
+      if batch is None:
+         logging.info("Caching {}".format(f))
+         with open(f, 'r') as csvfile:
+            cache.build(self._readLoans(csvfile))
+         batch = cache.load()
+      return batch
+
+
+   def _parseBatch(self, batch):
+      self._gatherBatchStats(batch, self.Filt.mask_batch(batch))
+
+
+   # Batch counterpart of _gatherDefaultStats and _gatherStereotypeStats for the loans selected by mask
+   def _gatherBatchStats(self, batch, mask):
+      self._countBatch(batch, mask)
+      self.Profile.add_batch(batch, mask)
+
+
+   # Count the loans of a LoanBatch selected by mask, the way _gatherDefaultStats counts single loans
+   def _countBatch(self, batch, mask):
+      ages = loan_ages(_dates(batch.column('issue_d'), mask), _dates(batch.column('last_pymnt_d'), mask))
+      default = batch.column('loan_status').text_compare(operator.eq, "Charged Off")[mask]
+
+      counts = {}
+      for group,grouped in (('default', ages[default]), ('good', ages[~default])):
+         counts[group] = dict((int(age), int(n)) for age,n in zip(*np.unique(grouped, return_counts=True)))
+      self._merge(counts, {'default' : {}, 'good' : {}})
+
+
+   # Spread files, and optionally byte ranges of each file, across worker processes.
+   # Each worker returns partial stats, which are merged as they arrive.
+   def _parseParallel(self, processes, chunkBytes):
+      tasks = []
+      for f in self.Files:
+         if os.path.isfile(f):
+            logging.info("Gathering Stats on {}".format(f))
+            header, ranges = _splitFile(f, chunkBytes)
+            # Every chunk of a file must agree on column types, so infer them once up front
+            schema = HistorySchema.sample(f, self.Types)
+            tasks += [(self.Filt, f, header, start, end, self.keepLoans, schema, self.stereoColumns) for start,end in ranges]
+
+      pool = Pool(processes=processes)
+      try:
+         for counts,loans,profile in pool.imap_unordered(_ingestRange, tasks):
+            self._merge(counts, loans, profile)
+      finally:
+         pool.terminate()
+
+
+   def _merge(self, counts, loans, profile=None):
+      if profile is not None:
+         self.Profile.merge(profile)
+      for group in self.Counts:
+         merged = self.Counts[group]
+         for age,n in counts[group].items():
+            merged[age] = merged.get(age, 0) + n
+         kept = self.Loans[group]
+         for age,aged in loans[group].items():
+            kept.setdefault(age, []).extend(aged)
+
+
+   def _readLoans(self, fn, fieldnames=None, schema=None):
       csvRestKey = 'xkey'
       csvRestVal = 'xval'
-      results = []
 
-      # Assume line 1 holds the keys
-      for line,row in enumerate(csv.DictReader(fn, restkey=csvRestKey, restval=csvRestVal)):
+      # Assume line 1 holds the keys, unless they're given
+      rows = csv.DictReader(fn, fieldnames=fieldnames, restkey=csvRestKey, restval=csvRestVal)
+      if schema is None:
+         # Type columns from a sample of rows, then convert each value once as it's read
+         sample = list(itertools.islice(rows, 1000))
+         schema = HistorySchema.infer(rows.fieldnames or [], sample, self.Types)
+         rows = itertools.chain(sample, rows)
+
+      for line,row in enumerate(rows):
+         schema.convert(row)
          row.update({'csv_line' : line})
          loan = PastLoan(csvRestKey, csvRestVal, row)
 
          if loan.isValid():
-            results.append( (self.Filt.apply(loan, block=False), loan) )
-
-      for (res,loan) in results:
-         if res.get() == True:
-            self._gatherDefaultStats(loan)
-            self._gatherStereotypeStats(loan)
-
-      return True
+            yield loan
 
 
    # Clean up LendingClub CSV files
    def _scrubFile(self, f):
       logging.debug("Scrubbing " + f.name)
 
+      # Copy lines to a temporary file as we go rather than holding them all in memory
+      tmp = f.name + '.scrub'
       scrubbed = False
-      newlines = []
-      for line in [l.rstrip('\n') for l in f]:
-         # Drop everything after and including first non-CSV line
-         #  (Declined loans and/or footer text)
-         if re.match('^[^"]', line):
-            scrubbed = True
+      with open(tmp, 'w') as out:
+         for line in f:
+            # Drop everything after and including first non-CSV line
+            #  (Declined loans and/or footer text)
+            if re.match('^[^"]', line):
+               scrubbed = True
 
-            logging.debug("\n'{}'\n is not valid CSV".format(line))
-            break
+               logging.debug("\n'{}'\n is not valid CSV".format(line.rstrip('\n')))
+               break
 
-         newlines.append(line)
+            out.write(line.rstrip('\n') + '\n')
 
-      if scrubbed:
-         # Reopen to overwrite
-         new = f.name
-         f.close()
+      if not scrubbed:
+         os.remove(tmp)
+         return f
 
-         logging.info("CSV File has been scrubbed")
-         new = input("Save scrubbed CSV as [{}]: ".format(new)) or new
+      # Reopen to overwrite
+      new = f.name
+      f.close()
 
-         f = open(new, 'w+')
-         for line in newlines:
-            f.write(line + '\n')
+      logging.info("CSV File has been scrubbed")
+      new = input("Save scrubbed CSV as [{}]: ".format(new)) or new
 
-      return f
+      os.replace(tmp, new)
+      return open(new, 'r')
 
 
    # Determine % of filtered loans that will default in specified ranges of time
    def _gatherDefaultStats(self, loan):
       logging.debug("Collecting loan {}".format(loan['id']))
-      if loan['loan_status'] == "Charged Off":
-         loans = self.Loans['default']
-      else:
-         loans = self.Loans['good']
+      group = 'default' if loan['loan_status'] == "Charged Off" else 'good'
 
-      # Put the loan into its age bucket
+      # Count the loan in its age bucket
       age = loan.getAge()
-      if age not in loans:
-         loans[age] = []
-      loans[age].append(loan)
+      counts = self.Counts[group]
+      counts[age] = counts.get(age, 0) + 1
+
+      if self.keepLoans:
+         loans = self.Loans[group]
+         if age not in loans:
+            loans[age] = []
+         loans[age].append(loan)
 
 
    def _gatherStereotypeStats(self, loan):
       # Count frequency of other properties on loans that pass the filter
-      pass
+      self.Profile.add(loan)
 
 
-   def _countByAge(self, loans, months):
-      # Loans that lived longer than our last bucket
-      count = {-1 : 0}
-      count[-1] += sum( [len(loans) for iAge,loans in loans.items() if iAge >= months[-1]] )
+   # Dense histogram of loans by age: hist[age] is the number of loans that lived age months
+   def _histogram(self, counts, size=0):
+      if counts:
+         size = max(size, max(counts) + 1)
+      hist = np.zeros(size, dtype=np.int64)
+      if counts:
+         hist[np.fromiter(counts.keys(), dtype=np.int64)] = np.fromiter(counts.values(), dtype=np.int64)
+      return hist
 
-      prev_m = 0
-      for m in months:
-         count[m] = 0
 
-         # Count the loans that lived between (prev_m -> m) months
-         count[m] += sum( [len(loans) for iAge,loans in loans.items() if iAge < m and iAge >= prev_m] )
-         prev_m = m
+   def _countByAge(self, counts, months):
+      # below[i] is the number of loans younger than months[i]
+      cumulative = np.concatenate([[0], np.cumsum(self._histogram(counts))])
+      below = cumulative[np.minimum(months, len(cumulative) - 1)]
 
+      # Loans that lived between (prev_m -> m) months, and longer than our last bucket
+      count = dict(zip(months, np.diff(np.concatenate([[0], below])).tolist()))
+      count[-1] = int(cumulative[-1] - below[-1])
       return count
 
 
+   # Kaplan-Meier estimate of the share of loans that haven't defaulted by each age. Loans that were
+   # paid off, or are still current, only count as at risk up to their age.
+   def survival(self):
+      size = max(list(self.Counts['default']) + list(self.Counts['good']) + [-1]) + 1
+      defaults = self._histogram(self.Counts['default'], size)
+      good = self._histogram(self.Counts['good'], size)
+
+      # Loans still around at the start of each month of age
+      atRisk = np.cumsum((defaults + good)[::-1])[::-1]
+      hazard = np.divide(defaults, atRisk, out=np.zeros(len(atRisk)), where=atRisk > 0)
+      return {'at_risk' : atRisk.tolist(),
+              'defaults' : defaults.tolist(),
+              'hazard' : hazard.tolist(),
+              'survival' : np.cumprod(1 - hazard).tolist()}
+
+
    # Determine the default rate of loans that passed the filter, and when they defaulted
-   def defaultRate(self, months=[1,3,6,12,18]):
+   def defaultRate(self, months=[1,3,6,12,18], output=True):
+      months = sorted(months)
       logging.debug("Calculating default rate at " + ", ".join( [str(month) for month in months] ) + " months" )
 
-      # TODO: Loan age using loan.getAge()
-      defaultCnt = self._countByAge(self.Loans['default'], months)
-      goodCnt = self._countByAge(self.Loans['good'], months)
+      defaultCnt = self._countByAge(self.Counts['default'], months)
+      goodCnt = self._countByAge(self.Counts['good'], months)
 
+      good = sum( goodCnt.values() )
+      total = sum( defaultCnt.values() ) + good
+      curves = self.survival()
+
+      buckets = []
+      prev_m = 0
+      for m in months + [-1]:
+         buckets.append({'from' : prev_m,
+                         'to' : m if m != -1 else None,
+                         'defaults' : defaultCnt[m],
+                         'rate' : defaultCnt[m]/total if total else 0.0})
+         prev_m = m
+      # Survival at the end of each bucket. Beyond the oldest loan, it no longer changes
+      survival = curves['survival']
+      for bucket in buckets[:-1]:
+         bucket['survival'] = survival[min(bucket['to'], len(survival)) - 1] if survival and bucket['to'] else 1.0
 
-      total = sum( defaultCnt.values() )
-      total += sum( goodCnt.values() )
+      result = {'total' : total, 'good' : good, 'buckets' : buckets}
+      result.update(curves)
 
+      if output:
+         self._printDefaultRate(result)
+      return result
+
+
+   def _printDefaultRate(self, result):
+      total = result['total']
       print ("{:d} loans passed the filter...".format(total))
       if total == 0:
          return
 
-      print ( "{:d} did not default".format( sum(goodCnt.values()) ) )
+      print ( "{:d} did not default".format( result['good'] ) )
 
-      prev_m = 0
-      for m in months:
-         mDefaults = defaultCnt[m]
-         print ( "{:.2%} ({:d}) defaulted between {:d} and {:d} months".format( mDefaults/total, mDefaults, prev_m, m) )
-
-         prev_m = m
+      for bucket in result['buckets'][:-1]:
+         print ( "{:.2%} ({:d}) defaulted between {:d} and {:d} months ({:.2%} survival)".format(
+                 bucket['rate'], bucket['defaults'], bucket['from'], bucket['to'], bucket['survival']) )
 
-      mDefaults = defaultCnt[-1]
-      print ( "{:.2%} ({:d}) defaulted after {:d} months".format( mDefaults/total, mDefaults, prev_m) )
+      bucket = result['buckets'][-1]
+      print ( "{:.2%} ({:d}) defaulted after {:d} months".format( bucket['rate'], bucket['defaults'], bucket['from']) )
 
-   def stereoType(self):
-      pass
+   # Describe the loans that passed the filter: common values, distinct values and quantiles per column
+   def stereoType(self, top=5, output=True):
+      result = self.Profile.result(top)
+      if output:
+         for key in sorted(result):
+            column = result[key]
+            print ("{}: {:d} value(s), ~{:d} distinct".format(key, column['count'], column['distinct']))
+            if column['quantiles'] is not None:
+               print ("\t" + ", ".join( ["p{:g} {:g}".format(100 * q, v) for q,v in sorted(column['quantiles'].items())] ))
+            print ("\t" + ", ".join( ["{} ({:d})".format(v, n) for v,n in column['top']] ))
+      return result
 
 
-def historyTest(files, periods):
-   nh = LoanHistory( BasicFilter('{id} > 0'), files)
+def historyTest(files, periods, processes=1, chunkBytes=None, cache=False, types=None, stereotype=False):
+   # Without worker processes per file, filter rows on a worker pool instead
+   nh = LoanHistory( FilterSet([BasicFilter('{id} > 0')], processes=None if processes == 1 else 1), files, processes=processes, chunkBytes=chunkBytes, cache=cache, types=types,
+                     stereoColumns=None if stereotype else [])
    nh.defaultRate( periods )
+   if stereotype:
+      nh.stereoType()
 
 
 def printUsage():
@@ -165,6 +426,12 @@ def printUsage():
    print ("\t-p|--period <n>\n\t\tSpecify points in time (in months) that you want to know the loan default rate of")
    print ("\t\tExample: '-p 6 -p 12 -p 18 -p 36' will tell you how many loans defaulted before 6 months, between 6 and 12, etc.")
    print ("\t-l|--log <level>\n\t\tSpecify the log level")
+   print ("\t-j|--jobs <n>\n\t\tParse files across n worker processes")
+   print ("\t-c|--chunk <MB>\n\t\tWith -j, also split each file into chunks of about this many megabytes")
+   print ("\t-s|--schema <filename>\n\t\tJSON file mapping column names to types (int, float, percent, months, date, categorical, text)")
+   print ("\t\tColumns that aren't listed are typed from a sample of rows")
+   print ("\t-t|--stereotype\n\t\tAlso describe the loans that passed the filter, column by column")
+   print ("\t-C|--cache\n\t\tParse each file once into a columnar cache (<file>.cache) and reuse it on later runs")
 
 if (__name__) == "__main__":
    if (len(sys.argv) < 2):
@@ -174,10 +441,15 @@ if (__name__) == "__main__":
    log_level = "WARNING"
    files = []
    periods = []
+   processes = 1
+   chunkBytes = None
+   cache = False
+   types = None
+   stereotype = False
 
    # Get the command line arguments
    try:
-      opts, args = getopt.getopt(sys.argv[1:], "hf:p:l:", ["help", "file=", "period=", "log="])
+      opts, args = getopt.getopt(sys.argv[1:], "hf:p:l:j:c:s:tC", ["help", "file=", "period=", "log=", "jobs=", "chunk=", "schema=", "stereotype", "cache"])
    except getopt.GetoptError:
       printUsage()
       sys.exit(1)
@@ -192,6 +464,17 @@ if (__name__) == "__main__":
          periods.append(int(arg))
       elif opt in ("-l", "--log"):
          log_level = arg
+      elif opt in ("-j", "--jobs"):
+         processes = int(arg)
+      elif opt in ("-c", "--chunk"):
+         chunkBytes = int(float(arg) * 1024 * 1024)
+      elif opt in ("-s", "--schema"):
+         with open(arg) as schemaFile:
+            types = json.load(schemaFile)
+      elif opt in ("-t", "--stereotype"):
+         stereotype = True
+      elif opt in ("-C", "--cache"):
+         cache = True
       else:
          printUsage()
          sys.exit(1)
@@ -211,5 +494,5 @@ if (__name__) == "__main__":
    if len(periods) == 0:
       periods = [6, 12, 24, 36, 48]
 
-   historyTest(files, periods)
+   historyTest(files, periods, processes, chunkBytes, cache, types, stereotype)
 
@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import hashlib
+import json
+import logging
+import time
+
+from lenderbot import Loan
+
+# Fields that describe where a note is in its life. A change to any of them is a status change.
+STATUS_FIELDS = ('loanStatus', 'loanStatusDate')
+
+
+def status_hash(note):
+    status = json.dumps([note.get(field) for field in STATUS_FIELDS])
+    return hashlib.sha1(status.encode('utf-8')).hexdigest()[:16]
+
+
+class NoteSnapshot:
+    """
+    A cached copy of detailed note information, refreshed at most once every `ttl` seconds.
+    Every refresh compares a hash of each note's status fields with the previous snapshot and
+    remembers which notes changed, so monitoring only has to look at those.
+    """
+
+    def __init__(self, path, ttl=3600):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.ttl = ttl
+        self.timestamp = 0
+        self.raw_notes = []
+        self.hashes = {}
+        self.changed = []
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.path) as handle:
+                snapshot = json.load(handle)
+        except (IOError, ValueError):
+            return
+        self.timestamp = snapshot['timestamp']
+        self.raw_notes = snapshot['notes']
+        self.hashes = snapshot['hashes']
+        self.changed = snapshot['changed']
+
+    def save(self):
+        snapshot = {'timestamp': self.timestamp, 'notes': self.raw_notes, 'hashes': self.hashes, 'changed': self.changed}
+        try:
+            with open(self.path, 'w') as handle:
+                json.dump(snapshot, handle)
+        except IOError:
+            self.logger.warning('Unable to save note snapshot to %s', self.path)
+
+    def is_fresh(self):
+        return time.time() - self.timestamp < self.ttl
+
+    def refresh(self, driver):
+        """Download detailed notes and record which notes changed status since the last snapshot."""
+        raw_notes = []
+        hashes = {}
+        changed = set(self.changed)  # Changes nobody has looked at yet still count
+        for note in driver.iter_detailed_notes_owned():
+            key = str(note['noteId'])
+            digest = status_hash(note)
+            hashes[key] = digest
+            if self.hashes.get(key) != digest:
+                changed.add(key)
+            raw_notes.append(note.to_dict())
+
+        if not raw_notes and self.raw_notes:
+            # Most likely a failed request. Keep what we have and try again next time
+            self.logger.warning('No notes received. Keeping previous snapshot')
+            return
+        self.timestamp = time.time()
+        self.raw_notes = raw_notes
+        self.hashes = hashes
+        self.changed = sorted(key for key in changed if key in hashes)
+        self.logger.debug('Note snapshot refreshed: %d note(s), %d changed', len(raw_notes), len(self.changed))
+        self.save()
+
+    def notes(self, driver):
+        """Return all detailed notes, refreshing the snapshot if it has expired."""
+        if not self.is_fresh():
+            self.refresh(driver)
+        return [Loan.DetailedOwnedNote(raw) for raw in self.raw_notes]
+
+    def pop_changed(self, driver):
+        """Return the notes whose status changed since they were last popped."""
+        if not self.is_fresh():
+            self.refresh(driver)
+        changed = set(self.changed)
+        notes = [Loan.DetailedOwnedNote(raw) for raw in self.raw_notes if str(raw['noteId']) in changed]
+        if self.changed:
+            self.changed = []
+            self.save()
+        return notes
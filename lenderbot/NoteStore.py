@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+
+import json
+import logging
+import sqlite3
+import threading
+import time
+
+
+class NoteStore:
+    """
+    A local SQLite copy of owned notes keyed by loan ID, with an in-memory set of loan IDs
+    for constant time ownership checks. The store is kept current from order confirmations
+    and periodically re-synced with the full list of owned notes.
+    """
+
+    def __init__(self, path):
+        self.logger = logging.getLogger(__name__)
+        self.path = path
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS notes (loanId INTEGER PRIMARY KEY, noteId INTEGER, data TEXT)')
+            self.db.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.loan_ids = set(row[0] for row in self.db.execute('SELECT loanId FROM notes'))
+        self.refresh_thread = None
+        # Incremented whenever a sync starts downloading notes. Notes added since then may be
+        # missing from the download, so the sync must not treat them as stale.
+        self.generation = 0
+        self.added = {}  # loan ID -> generation it was added in
+
+    def __contains__(self, loan_id):
+        return loan_id in self.loan_ids
+
+    def __len__(self):
+        return len(self.loan_ids)
+
+    def close(self):
+        if self.refresh_thread is not None:
+            self.refresh_thread.join()
+        self.db.close()
+
+    def last_refresh(self):
+        """Return the time of the last full sync, or None if the store has never been synced."""
+        row = self.db.execute("SELECT value FROM meta WHERE key = 'last_refresh'").fetchone()
+        return float(row[0]) if row else None
+
+    def _upsert(self, notes):
+        rows = [(note['loanId'], note.get('noteId'), json.dumps(dict(note.items()))) for note in notes]
+        self.db.executemany('INSERT OR REPLACE INTO notes (loanId, noteId, data) VALUES (?, ?, ?)', rows)
+        return [row[0] for row in rows]
+
+    def add(self, notes):
+        """Record newly owned notes. Each note needs at least a 'loanId'."""
+        with self.lock, self.db:
+            for loan_id in self._upsert(notes):
+                self.loan_ids.add(loan_id)
+                self.added[loan_id] = self.generation
+
+    def add_confirmations(self, confirmations):
+        """Record notes from successful order confirmations, as returned by Investor.submit_order()."""
+        self.add([c for c in confirmations if 'loanId' in c])
+
+    def replace(self, notes, since=None):
+        """
+        Sync the store with the complete list of owned notes. If the list was downloaded by a sync
+        that started at generation `since`, notes added after that are kept even if it lacks them.
+        """
+        with self.lock, self.db:
+            loan_ids = set(self._upsert(notes))
+            recent = set(loan_id for loan_id, generation in self.added.items()
+                         if since is not None and generation >= since)
+            stale = [(loan_id,) for loan_id in self.loan_ids - loan_ids - recent]
+            self.db.executemany('DELETE FROM notes WHERE loanId = ?', stale)
+            self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('last_refresh', ?)", (str(time.time()),))
+            self.loan_ids = loan_ids | recent
+            self.added = dict((loan_id, self.added[loan_id]) for loan_id in recent)
+        self.logger.debug('Note store synced: %d note(s) owned', len(self.loan_ids))
+
+    def refresh(self, driver):
+        """Download the full list of owned notes and sync the store with it."""
+        with self.lock:
+            self.generation += 1
+            since = self.generation
+        notes = driver.get_notes_owned()
+        # An empty list usually means the request failed. Never wipe the store because of it,
+        # but an empty store has nothing to lose, so record that it was synced.
+        if notes or not self.loan_ids:
+            self.replace(notes, since)
+        return len(notes)
+
+    def refresh_async(self, driver):
+        """Sync the store in a background thread."""
+        self.refresh_thread = threading.Thread(target=self.refresh, args=(driver,), name='NoteStoreRefresh')
+        self.refresh_thread.daemon = True
+        self.refresh_thread.start()
+        return self.refresh_thread
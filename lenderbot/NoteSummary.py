@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+GRADES = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
+
+
+class NoteSummary:
+    """
+    Summarize owned notes in a single pass. Notes can be streamed in one at a time with add(),
+    and only counters, sums and the (few) late notes are kept.
+    """
+
+    def __init__(self, include_closed=False):
+        self.include_closed = include_closed
+        self.total = 0
+        self.status = {'current': 0, 'late': 0, 'open': 0, 'closed': 0, 'review': 0}
+        self.loan_status = {}
+        self.grades = dict((grade, 0) for grade in GRADES)
+        self.sub_grades = {}
+        self.summary_notes = 0
+        self.rate_sum = 0.0
+        self.principal_outstanding = 0.0
+        self.late_notes = []
+
+    def add(self, note):
+        self.total += 1
+        status = note['loanStatus']
+        self.loan_status[status] = self.loan_status.get(status, 0) + 1
+
+        is_open = note.is_open()
+        if note.is_current():
+            self.status['current'] += 1
+        if note.is_late():
+            self.status['late'] += 1
+            self.late_notes.append(note)
+        if is_open:
+            self.status['open'] += 1
+            self.principal_outstanding += note.get('principalPending') or 0
+        else:
+            self.status['closed'] += 1
+        if not note.is_issued():
+            self.status['review'] += 1
+
+        # Rates and grades describe open notes, plus closed ones if requested
+        if is_open or self.include_closed:
+            self.summary_notes += 1
+            self.rate_sum += note['interestRate']
+            sub_grade = note['grade']
+            if sub_grade:
+                self.sub_grades[sub_grade] = self.sub_grades.get(sub_grade, 0) + 1
+                if sub_grade[0] in self.grades:
+                    self.grades[sub_grade[0]] += 1
+
+    def update(self, notes):
+        for note in notes:
+            self.add(note)
+        return self
+
+    def result(self):
+        """Return the summary as a JSON serializable dict."""
+        return {
+            'total': self.total,
+            'include_closed': self.include_closed,
+            'status': dict(self.status),
+            'loan_status': dict(self.loan_status),
+            'summary_notes': self.summary_notes,
+            'average_rate': self.rate_sum / self.summary_notes if self.summary_notes else 0.0,
+            'grades': dict(self.grades),
+            'sub_grades': dict(self.sub_grades),
+            'principal_outstanding': self.principal_outstanding,
+            'late_notes': [dict(note.items()) for note in self.late_notes],
+        }
+
+    def late_text(self):
+        summary = '%d late note(s)' % (self.status['late'])
+        for note in self.late_notes:
+            summary += '\n%s' % (note)
+        return summary
+
+    def text(self):
+        res = self.result()
+        summary = '%d note(s) owned at an average interest rate of %.2f%%\n' % (res['summary_notes'], res['average_rate'])
+        summary += '%d open note(s):\n' % (res['status']['open'])
+        summary += '  %d current note(s)\n' % (res['status']['current'])
+        if self.include_closed:
+            summary += '  %d closed note(s)\n' % (res['status']['closed'])
+        summary += '  %d late note(s)\n' % (res['status']['late'])
+        summary += '  %d note(s) in review\n' % (res['status']['review'])
+        grade_summary = '  Grades - '
+        for grade in GRADES:
+            grade_summary += '%c: %d  ' % (grade, res['grades'][grade])
+        summary += grade_summary
+        return summary
@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+import threading
+import time
+
+
+class TokenBucket(object):
+    """
+    A thread safe token bucket rate limiter on a monotonic clock.
+    Tokens refill continuously at `rate` per second, up to `burst` tokens. Each request
+    takes one token and waits exactly as long as it takes for that token to become available.
+    """
+
+    def __init__(self, rate=1.0, burst=1, clock=time.monotonic, sleep=time.sleep):
+        self.rate = float(rate)
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = float(burst)
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        """Take a token and return the number of seconds to wait before it may be used."""
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            # Tokens go negative while requests are waiting, so waiters are served in order
+            self.tokens -= 1
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+    def acquire(self):
+        """Block until a request may be sent."""
+        wait = self.reserve()
+        if wait > 0:
+            self.sleep(wait)
+        return wait
@@ -0,0 +1,83 @@
+#!/usr/bin/env python3
+
+from datetime import datetime, time as dtime, timedelta, timezone as dtimezone
+import logging
+import re
+import time
+
+try:
+    from zoneinfo import ZoneInfo
+except ImportError:
+    ZoneInfo = None
+
+
+def resolve_timezone(name):
+    """
+    Return a tzinfo for an IANA time zone name or a fixed UTC offset such as '-08:00'.
+    Names need the zoneinfo module (Python 3.9 or later). Offsets work everywhere, but don't
+    follow daylight saving time.
+    """
+    m = re.match(r'^(?:UTC)?([+-])(\d{1,2}):?(\d{2})$', name)
+    if m:
+        offset = timedelta(hours=int(m.group(2)), minutes=int(m.group(3)))
+        return dtimezone(-offset if m.group(1) == '-' else offset)
+    if name == 'UTC':
+        return dtimezone.utc
+    if ZoneInfo is None:
+        raise ValueError('Time zone names like \'%s\' need Python 3.9 or later. '
+                         'Use a fixed UTC offset such as \'-08:00\' instead' % (name))
+    try:
+        return ZoneInfo(name)
+    except (KeyError, ValueError):
+        raise ValueError('Unknown time zone \'%s\'' % (name))
+
+
+class ListingScheduler:
+    """
+    Knows when new loans are released and how long to poll for them.
+    Release times are 'HH:MM' strings, interpreted in `timezone` (an IANA name such as
+    'America/Los_Angeles', or a fixed UTC offset such as '-08:00') or in local time when no
+    timezone is given.
+    """
+
+    def __init__(self, release_times, lead_seconds=10, window_seconds=60, timezone=None,
+                 now=None, sleep=time.sleep):
+        self.logger = logging.getLogger(__name__)
+        self.release_times = sorted(datetime.strptime(t, '%H:%M').time() for t in release_times)
+        self.lead = timedelta(seconds=lead_seconds)
+        self.window = timedelta(seconds=window_seconds)
+        self.tz = resolve_timezone(timezone) if timezone else None
+        self._now = now
+        self.sleep = sleep
+
+    def now(self):
+        if self._now is not None:
+            return self._now()
+        return datetime.now(self.tz)
+
+    def next_release(self, now=None):
+        """Return the next release whose polling window has not yet closed."""
+        now = now or self.now()
+        for days in range(0, 2):
+            day = now.date() + timedelta(days=days)
+            for t in self.release_times:
+                release = datetime.combine(day, dtime(t.hour, t.minute, tzinfo=self.tz))
+                if release + self.window > now:
+                    return release
+        raise ValueError('No listing release times configured')
+
+    def wait_for(self, release):
+        """Sleep until shortly before a release. Returns the number of seconds slept."""
+        delay = (release - self.lead - self.now()).total_seconds()
+        if delay > 0:
+            self.logger.info('Sleeping %d second(s) until %s listing release', delay, release.strftime('%H:%M'))
+            self.sleep(delay)
+            return delay
+        return 0
+
+    def seconds_since(self, release):
+        return (self.now() - release).total_seconds()
+
+    def window_open(self, release):
+        """True while we should keep polling for loans released at `release`."""
+        return self.now() < release + self.window
@@ -0,0 +1,353 @@
+#!/usr/bin/env python3
+
+"""
+Bounded-memory, mergeable summaries of loan columns.
+
+    SpaceSaving   most frequent values, with approximate counts
+    HyperLogLog   number of distinct values, within about 1.04 / sqrt(2 ** precision)
+    TDigest       quantiles, most accurate near the tails
+
+Each summary can be merged with another of the same kind and size, so chunks
+of a file can be summarized in separate processes and combined afterwards.
+Values are hashed with blake2b rather than hash(), which is salted per process.
+"""
+
+import bisect
+import hashlib
+import heapq
+import itertools
+import math
+from collections import Counter
+from operator import itemgetter
+
+import numpy as np
+
+from lenderbot.ColumnFilter import NUM
+
+
+def _hash64(value):
+    return int.from_bytes(hashlib.blake2b(repr(value).encode('utf-8'), digest_size=8).digest(), 'little')
+
+
+class SpaceSaving(object):
+    """
+    Approximate counts of the most frequent values, using at most `capacity` counters. Counts are
+    overestimates: a value's true count is between count - error and count.
+    """
+
+    def __init__(self, capacity=64):
+        self.capacity = capacity
+        # value -> [count, error]
+        self.counters = {}
+        # Upper bound on the count of any value without a counter
+        self.floor = 0
+        # (count, sequence, value) entries for finding the smallest counter. Entries go stale as
+        # counts grow. Stale entries are skipped when popped, and dropped when the heap is rebuilt.
+        self.heap = []
+        self.sequence = 0
+
+    def _push(self, value):
+        self.sequence += 1
+        heapq.heappush(self.heap, (self.counters[value][0], self.sequence, value))
+        if len(self.heap) > 4 * self.capacity:
+            self._heapify()
+
+    def _heapify(self):
+        self.heap = []
+        for value, counter in self.counters.items():
+            self.sequence += 1
+            self.heap.append((counter[0], self.sequence, value))
+        heapq.heapify(self.heap)
+
+    def _pop_min(self):
+        while True:
+            count, _, value = heapq.heappop(self.heap)
+            counter = self.counters.get(value)
+            if counter is not None and counter[0] == count:
+                return value
+
+    def add(self, value, count=1):
+        counter = self.counters.get(value)
+        if counter is not None:
+            counter[0] += count
+        else:
+            if len(self.counters) >= self.capacity:
+                # Replace the least frequent value. The newcomer may have been counted there before
+                self.floor = self.counters.pop(self._pop_min())[0]
+            self.counters[value] = [self.floor + count, self.floor]
+        self._push(value)
+
+    def update(self, counts):
+        """Add the exact counts of a block of values, given as a value -> count dict."""
+        summary = SpaceSaving(self.capacity)
+        if len(counts) > self.capacity:
+            ranked = heapq.nlargest(self.capacity + 1, counts.items(), key=itemgetter(1))
+            # Values left out of the block's summary occurred at most as often as the first one left out
+            summary.floor = ranked.pop()[1]
+            counts = dict(ranked)
+        summary.counters = dict((value, [count, 0]) for value, count in counts.items())
+        return self.merge(summary)
+
+    def merge(self, other):
+        """
+        Add another summary's counts. A value missing from either summary may have occurred up to
+        that summary's floor times, so the floor is added to both its count and its error.
+        """
+        merged = {}
+        for value in itertools.chain(self.counters, (v for v in other.counters if v not in self.counters)):
+            count = error = 0
+            for summary in (self, other):
+                counter = summary.counters.get(value)
+                if counter is None:
+                    count += summary.floor
+                    error += summary.floor
+                else:
+                    count += counter[0]
+                    error += counter[1]
+            merged[value] = [count, error]
+        floor = self.floor + other.floor
+        if len(merged) > self.capacity:
+            ranked = sorted(merged.items(), key=lambda item: -item[1][0])
+            floor = max(floor, ranked[self.capacity][1][0])
+            merged = dict(ranked[:self.capacity])
+        self.counters = merged
+        self.floor = floor
+        self._heapify()
+        return self
+
+    def top(self, n=10):
+        """Return up to n (value, count, error) tuples, most frequent first."""
+        ranked = sorted(self.counters.items(), key=lambda item: -item[1][0])[:n]
+        return [(value, count, error) for value, (count, error) in ranked]
+
+
+class HyperLogLog(object):
+    'Approximate number of distinct values, in 2 ** precision bytes.'
+
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, value):
+        h = _hash64(value)
+        index = h >> (64 - self.precision)
+        rest = h & ((1 << (64 - self.precision)) - 1)
+        # Position of the first 1 bit in the remaining bits
+        rank = (64 - self.precision) - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, other):
+        if other.precision != self.precision:
+            raise ValueError('Can only merge HyperLogLogs of the same precision')
+        self.registers = bytearray(max(a, b) for a, b in zip(self.registers, other.registers))
+        return self
+
+    def count(self):
+        m = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / m)
+        estimate = alpha * m * m / sum(2.0 ** -r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * m and zeros:
+            # Small range correction
+            estimate = m * math.log(float(m) / zeros)
+        return int(round(estimate))
+
+
+class TDigest(object):
+    'Approximate quantiles of a stream of numbers, as at most a few times `compression` centroids.'
+
+    def __init__(self, compression=100):
+        self.compression = compression
+        self.means = []
+        self.weights = []
+        self.buffer = []
+        self.total = 0
+        self.min = float('inf')
+        self.max = float('-inf')
+
+    def add(self, value, weight=1):
+        self.buffer.append((float(value), weight))
+        if len(self.buffer) >= 10 * self.compression:
+            self._compress()
+
+    def update(self, counts):
+        """Add a block of values, given as a value -> count dict."""
+        self.buffer.extend((float(value), count) for value, count in counts.items())
+        if len(self.buffer) >= 10 * self.compression:
+            self._compress()
+
+    def merge(self, other):
+        self.buffer.extend(zip(other.means, other.weights))
+        self.buffer.extend(other.buffer)
+        self._compress()
+        return self
+
+    def _compress(self):
+        if not self.buffer:
+            return
+        items = sorted(list(zip(self.means, self.weights)) + self.buffer)
+        self.buffer = []
+        self.min = min(self.min, items[0][0])
+        self.max = max(self.max, items[-1][0])
+        total = sum(weight for _, weight in items)
+
+        means = []
+        weights = []
+        before = 0
+        for mean, weight in items:
+            if means:
+                # Centroids may hold more weight in the middle of the distribution than near the tails
+                q = (before + (weights[-1] + weight) / 2.0) / total
+                if weights[-1] + weight <= max(1, 4 * total * q * (1 - q) / self.compression):
+                    merged = weights[-1] + weight
+                    means[-1] += (mean - means[-1]) * weight / merged
+                    weights[-1] = merged
+                    continue
+                before += weights[-1]
+            means.append(mean)
+            weights.append(weight)
+        self.means = means
+        self.weights = weights
+        self.total = total
+
+    def quantile(self, q):
+        self._compress()
+        if not self.means:
+            return None
+        if len(self.means) == 1:
+            return self.means[0]
+        # Each centroid's mean sits at the middle of its weight
+        target = q * self.total
+        centers = []
+        seen = 0
+        for weight in self.weights:
+            centers.append(seen + weight / 2.0)
+            seen += weight
+        if target <= centers[0]:
+            return self.min + (self.means[0] - self.min) * target / centers[0] if centers[0] else self.min
+        if target >= centers[-1]:
+            span = self.total - centers[-1]
+            return self.means[-1] + (self.max - self.means[-1]) * (target - centers[-1]) / span if span else self.max
+        i = bisect.bisect_right(centers, target)
+        fraction = (target - centers[i - 1]) / (centers[i] - centers[i - 1])
+        return self.means[i - 1] + (self.means[i] - self.means[i - 1]) * fraction
+
+
+QUANTILES = (0.05, 0.25, 0.5, 0.75, 0.95)
+
+
+def _key(value):
+    # Numbers compare and hash the same whether they were read as int or float
+    return float(value) if isinstance(value, (int, float)) and not isinstance(value, bool) else value
+
+
+class ColumnProfile(object):
+    """
+    Summary of the values of one column: frequent values, distinct count and, for numbers, quantiles.
+    Values are buffered and counted exactly a block at a time, so each summary is only updated
+    once per distinct value in the block.
+    """
+
+    def __init__(self, capacity=64, precision=12, compression=100, block=4096):
+        self.count = 0
+        self.top = SpaceSaving(capacity)
+        self.distinct = HyperLogLog(precision)
+        self.digest = TDigest(compression)
+        self.block = block
+        self.pending = []
+
+    def __getstate__(self):
+        self.flush()
+        return self.__dict__
+
+    def add(self, value):
+        if value is not None:
+            self.pending.append(_key(value))
+            if len(self.pending) >= self.block:
+                self.flush()
+
+    def flush(self):
+        if self.pending:
+            counts = Counter(self.pending)
+            self.pending = []
+            self.update(counts)
+
+    def update(self, counts):
+        """Add a block of values, given as a value -> count dict."""
+        self.count += sum(counts.values())
+        self.top.update(counts)
+        for value in counts:
+            self.distinct.add(value)
+        numbers = dict((value, count) for value, count in counts.items() if isinstance(value, float))
+        if numbers:
+            self.digest.update(numbers)
+
+    def merge(self, other):
+        self.flush()
+        other.flush()
+        self.count += other.count
+        self.top.merge(other.top)
+        self.distinct.merge(other.distinct)
+        self.digest.merge(other.digest)
+        return self
+
+    def result(self, n=10):
+        self.flush()
+        quantiles = dict((q, self.digest.quantile(q)) for q in QUANTILES) if self.digest.total or self.digest.buffer else None
+        return {
+            'count': self.count,
+            'distinct': self.distinct.count(),
+            'top': [(value, count) for value, count, _ in self.top.top(n)],
+            'quantiles': quantiles,
+        }
+
+
+class Profile(object):
+    """
+    ColumnProfiles for the loans that passed a filter. Only `columns` are profiled if given,
+    otherwise every column is, except those in `exclude`.
+    """
+
+    def __init__(self, columns=None, exclude=('csv_line',), **sizes):
+        self.columns = list(columns) if columns is not None else None
+        self.exclude = set(exclude)
+        self.sizes = sizes
+        self.profiles = {}
+
+    def _profile(self, key):
+        profile = self.profiles.get(key)
+        if profile is None:
+            profile = self.profiles[key] = ColumnProfile(**self.sizes)
+        return profile
+
+    def _keys(self, keys):
+        if self.columns is not None:
+            return [key for key in self.columns if key in keys]
+        return [key for key in keys if key not in self.exclude]
+
+    def add(self, loan):
+        for key in self._keys(loan.keys()):
+            self._profile(key).add(loan[key])
+
+    def add_batch(self, batch, mask):
+        """Profile the rows of a LoanBatch selected by a boolean mask."""
+        for key in self._keys(batch.keys()):
+            col = batch.column(key)
+            kind = col.kind[mask]
+            # Numbers are profiled as floats, however they're stored
+            numbers = col.num[mask][kind == NUM].astype(float)
+            for unique, counts in (np.unique(numbers, return_counts=True), col.text_counts(mask)):
+                if len(unique):
+                    self._profile(key).update(dict(zip(unique.tolist(), counts.tolist())))
+
+    def merge(self, other):
+        for key, profile in other.profiles.items():
+            if key in self.profiles:
+                self.profiles[key].merge(profile)
+            else:
+                self.profiles[key] = profile
+        return self
+
+    def result(self, n=10):
+        return dict((key, profile.result(n)) for key, profile in self.profiles.items())
@@ -0,0 +1,240 @@
+#!/usr/bin/env python3
+
+"""
+Sweep filter thresholds over LendingClub history files.
+
+A sweep is a list of filter templates. A template holds at most one range in
+square brackets, and expands to one rule per value in the range:
+
+    {inqLast6Mths} <= [0..3]      4 rules, {inqLast6Mths} <= 0 through 3
+    {revolUtil} < [50..90:20]     3 rules, with a step of 20
+    {term} == [36,60]             2 rules, one per listed value
+    {grade} in [C..F]             10 rules, one per grade interval: C <= {grade} <= C, C <= {grade} <= D, ...
+    {purpose} != house            1 rule, as written
+
+Every combination of expanded rules is backtested (see Backtest). History
+files are parsed and typed once, into the columnar cache, and every worker
+memory-maps the same cache. Within a worker each distinct rule is evaluated
+once per file, and consecutive grid points reuse the AND of the rules they
+share.
+"""
+
+import getopt
+import itertools
+import json
+import logging
+import re
+import sys
+from multiprocessing import Pool, cpu_count
+
+import numpy as np
+
+from lenderbot.Backtest import Outcomes, Performance, history_rule
+from lenderbot.LoanFilter import BasicFilter, FilterSet
+from lenderbot.LoanHistory import LoanHistory
+
+_RANGE = re.compile(r'\[([^\]]*)\]')
+_IN = re.compile(r'^\s*(\{\w+\})\s+in\s+\[([^\]]*)\]\s*$')
+
+
+def _number(text):
+    value = float(text)
+    return int(value) if value.is_integer() and '.' not in text else value
+
+
+def expand_range(spec):
+    """Return the values of a range spec: 'lo..hi', 'lo..hi:step' or 'a,b,c'."""
+    if '..' not in spec:
+        return [value.strip() for value in spec.split(',') if value.strip()]
+    bounds, _, step = spec.partition(':')
+    lo, hi = (bound.strip() for bound in bounds.split('..'))
+    if lo.isalpha() and hi.isalpha():
+        return [chr(c) for c in range(ord(lo), ord(hi) + 1)]
+    lo, hi = _number(lo), _number(hi)
+    step = _number(step) if step else 1
+    values = []
+    while lo <= hi + 1e-9:
+        values.append(lo)
+        # Rounded so float steps don't accumulate error into the rules
+        lo = round(lo + step, 10)
+    return [str(value) for value in values]
+
+
+def expand_template(template):
+    """Return the list of rules a template stands for."""
+    match = _IN.match(template)
+    if match:
+        key, values = match.group(1), expand_range(match.group(2))
+        return ['%s <= %s <= %s' % (lo, key, hi) for i, lo in enumerate(values) for hi in values[i:]]
+    match = _RANGE.search(template)
+    if not match:
+        return [template]
+    return [template[:match.start()] + value + template[match.end():] for value in expand_range(match.group(1))]
+
+
+class _Evaluator(object):
+    'Evaluates grid points over one LoanBatch, sharing rule masks and common prefixes.'
+
+    def __init__(self, batch):
+        self.batch = batch
+        self.outcomes = Outcomes(batch)
+        self.masks = {}
+        # (rule, mask passing every rule up to and including it) for the previous point
+        self.stack = []
+
+    def mask(self, rule):
+        mask = self.masks.get(rule)
+        if mask is None:
+            try:
+                mask = BasicFilter(history_rule(rule)).mask(self.batch)
+            except KeyError as e:
+                # No such column in this history. The rule doesn't narrow anything down
+                logging.getLogger(__name__).warning('Skipping %s: no %s column in the history', rule, e)
+                mask = np.ones(len(self.batch), dtype=bool)
+            self.masks[rule] = mask
+        return mask
+
+    def point(self, rules):
+        shared = 0
+        while shared < min(len(rules), len(self.stack)) and self.stack[shared][0] == rules[shared]:
+            shared += 1
+        del self.stack[shared:]
+        for rule in rules[shared:]:
+            prev = self.stack[-1][1] if self.stack else np.ones(len(self.batch), dtype=bool)
+            self.stack.append((rule, prev & self.mask(rule)))
+        return self.stack[-1][1] if self.stack else np.ones(len(self.batch), dtype=bool)
+
+
+def _sweepChunk(task):
+    """Pool worker: backtest a contiguous run of grid points over every file."""
+    files, cacheDir, types, points = task
+    history = LoanHistory(FilterSet([], processes=1), types=types)
+    results = [Performance() for _ in points]
+    for f in files:
+        evaluator = _Evaluator(history.loadCached(f, cacheDir))
+        for perf, rules in zip(results, points):
+            perf.add(evaluator.outcomes, evaluator.point(rules))
+    return [perf.result() for perf in results]
+
+
+def _objective(res):
+    # Yield, or the number of loans bought when the history has no payment data
+    return res['realized_return'] if res['realized_return'] is not None else res['loans']
+
+
+class Sweep(object):
+    """
+    The backtest results of every combination of expanded templates, and the frontier of
+    combinations no other combination beats on both default rate and yield.
+    """
+
+    def __init__(self, templates, files, processes=None, cacheDir=None, types=None, chunksize=64):
+        self.logger = logging.getLogger(__name__)
+        self.templates = list(templates)
+        self.files = list(files)
+        self.processes = processes
+        self.cacheDir = cacheDir
+        self.types = types
+        self.chunksize = chunksize
+        self.points = list(itertools.product(*[expand_template(t) for t in self.templates]))
+        self.results = []
+
+    def run(self):
+        # Parse and type each file once, up front, so workers only ever memory-map it
+        history = LoanHistory(FilterSet([], processes=1), types=self.types)
+        for f in self.files:
+            history.loadCached(f, self.cacheDir)
+
+        tasks = [(self.files, self.cacheDir, self.types, self.points[i:i + self.chunksize])
+                 for i in range(0, len(self.points), self.chunksize)]
+        self.logger.info('Sweeping %d combination(s) of %d template(s)', len(self.points), len(self.templates))
+        if self.processes == 1 or len(tasks) < 2:
+            chunks = [_sweepChunk(task) for task in tasks]
+        else:
+            pool = Pool(processes=self.processes or cpu_count())
+            try:
+                chunks = pool.map(_sweepChunk, tasks)
+            finally:
+                pool.terminate()
+
+        self.results = [dict(res, rules=list(rules)) for rules, res in zip(self.points, itertools.chain(*chunks))]
+        return self
+
+    def frontier(self, min_loans=1):
+        """Return the results no other result beats on both default rate and yield, by default rate."""
+        candidates = sorted((res for res in self.results if res['loans'] >= min_loans),
+                            key=lambda res: (res['default_rate'], -_objective(res)))
+        frontier = []
+        for res in candidates:
+            if not frontier or _objective(res) > _objective(frontier[-1]):
+                frontier.append(res)
+        return frontier
+
+    def result(self, min_loans=1):
+        """Return every result and the frontier as a JSON serializable dict."""
+        return {
+            'templates': self.templates,
+            'files': self.files,
+            'points': self.results,
+            'frontier': self.frontier(min_loans),
+        }
+
+    def text(self, min_loans=1):
+        summary = '%d combination(s) tested. Frontier:\n' % (len(self.results))
+        for res in self.frontier(min_loans):
+            summary += '  %.2f%% charged off' % (100 * res['default_rate'])
+            if res['realized_return'] is not None:
+                summary += ', %.2f%% realized return' % (100 * res['realized_return'])
+            summary += ', %d loan(s): %s\n' % (res['loans'], ' and '.join(res['rules']))
+        return summary
+
+
+def printUsage():
+    print ("\nUsage: {} <options> <history csv> [<history csv> ...]".format(sys.argv[0]) )
+    print ("\t-h|--help\n\t\tPrint this message and exit")
+    print ("\t-t|--templates <filename>\n\t\tJSON file with a 'filters' list of filter templates, like filters.json")
+    print ("\t-j|--jobs <n>\n\t\tNumber of worker processes (default: one per CPU)")
+    print ("\t-m|--minLoans <n>\n\t\tLeave combinations selecting fewer loans off the frontier")
+    print ("\t-o|--output <filename>\n\t\tAlso write every result and the frontier to a JSON file")
+    print ("\t-l|--log <level>\n\t\tSpecify the log level")
+
+
+if (__name__) == "__main__":
+    log_level = "WARNING"
+    templates = None
+    processes = None
+    min_loans = 1
+    output = None
+
+    try:
+        opts, files = getopt.getopt(sys.argv[1:], "ht:j:m:o:l:", ["help", "templates=", "jobs=", "minLoans=", "output=", "log="])
+    except getopt.GetoptError:
+        printUsage()
+        sys.exit(1)
+
+    for opt, arg in opts:
+        if opt in ("-h", "--help"):
+            printUsage()
+            sys.exit(1)
+        elif opt in ("-t", "--templates"):
+            with open(arg) as handle:
+                templates = json.load(handle)['filters']
+        elif opt in ("-j", "--jobs"):
+            processes = int(arg)
+        elif opt in ("-m", "--minLoans"):
+            min_loans = int(arg)
+        elif opt in ("-o", "--output"):
+            output = arg
+        elif opt in ("-l", "--log"):
+            log_level = arg
+    logging.basicConfig(level=log_level)
+
+    if templates is None or not files:
+        printUsage()
+        sys.exit(1)
+
+    sweep = Sweep(templates, files, processes=processes).run()
+    print (sweep.text(min_loans))
+    if output:
+        with open(output, 'w') as handle:
+            json.dump(sweep.result(min_loans), handle, indent=2)
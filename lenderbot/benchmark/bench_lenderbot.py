@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for lenderbot's hot paths, run against synthetic data.
+
+    python3 -m lenderbot.benchmark.bench_lenderbot --output results.json
+    python3 -m lenderbot.benchmark.bench_lenderbot --baseline results.json --rows 1000000
+
+Run it from the root of a lenderbot checkout. It reads example_config/filters.json.
+
+Listing payloads, owned notes and LoanStats history files are generated from a
+seed, so runs with the same sizes see the same data. Each benchmark runs
+--repeat times and reports its best time. Results are written as JSON, and
+compared with a baseline run when one is given: a benchmark whose time per item
+grew by more than --threshold is flagged, and the run exits with status 1.
+"""
+
+import argparse
+import contextlib
+import csv
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+from lenderbot import Investor
+from lenderbot import lenderbot
+from lenderbot import Loan
+from lenderbot import LoanFilter
+from lenderbot import LoanHistory
+from lenderbot import NoteStore
+
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'example_config')
+
+GRADES = 'ABCDEFG'
+PURPOSES = ['debt_consolidation', 'credit_card', 'home_improvement', 'other', 'major_purchase', 'small_business',
+            'car', 'medical', 'moving', 'vacation', 'house', 'wedding', 'renewable_energy', 'educational']
+STATES = ['CA', 'NY', 'TX', 'FL', 'IL', 'NJ', 'PA', 'OH', 'GA', 'VA', 'NC', 'MI', 'MA', 'WA', 'AZ', 'CO']
+HOME = ['MORTGAGE', 'RENT', 'OWN']
+MONTHS = ['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun', 'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']
+NOTE_STATUSES = ['Current'] * 12 + ['Issued', 'In Review', 'In Grace Period', 'Late (16-30 days)',
+                                    'Late (31-120 days)', 'Fully Paid', 'Fully Paid', 'Charged Off']
+
+# Listing fields beyond the ones built explicitly below, all small non-negative counts
+COUNT_FIELDS = ['accNowDelinq', 'accOpenPast24Mths', 'chargeoffWithin12Mths', 'collections12MthsExMed',
+                'delinq2Yrs', 'inqLast6Mths', 'mortAcc', 'numAcctsEver120Ppd', 'numActvBcTl', 'numActvRevTl',
+                'numBcSats', 'numBcTl', 'numIlTl', 'numOpRevTl', 'numRevAccts', 'numRevTlBalGt0', 'numSats',
+                'numTl120dpd2m', 'numTl30dpd', 'numTl90gDpd24m', 'numTlOpPast12m', 'openAcc', 'pubRec',
+                'pubRecBankruptcies', 'taxLiens', 'totalAcc']
+OPTIONAL_MONTH_FIELDS = ['mthsSinceLastDelinq', 'mthsSinceLastMajorDerog', 'mthsSinceLastRecord',
+                         'mthsSinceRecentBcDlq', 'mthsSinceRecentInq', 'mthsSinceRecentRevolDelinq']
+
+
+def _sub_grade(rng):
+    return rng.choice(GRADES[:6]) + str(rng.randint(1, 5))
+
+
+def _rate(sub_grade):
+    return round(5.5 + 4.2 * GRADES.index(sub_grade[0]) + 0.6 * int(sub_grade[1]), 2)
+
+
+def listing_loan(rng, loan_id):
+    """Return one listed loan, shaped like the LendingClub listing API's."""
+    sub_grade = _sub_grade(rng)
+    amount = rng.randrange(1000, 35001, 25)
+    term = rng.choice([36, 36, 60])
+    rate = _rate(sub_grade)
+    loan = {
+        'id': loan_id,
+        'memberId': loan_id + 1000000,
+        'loanAmount': float(amount),
+        'fundedAmount': float(rng.randrange(0, amount + 1, 25)),
+        'term': term,
+        'intRate': rate,
+        'expDefaultRate': round(rate / 3.0, 2),
+        'serviceFeeRate': 0.79,
+        'installment': round(amount * (rate / 1200.0) / (1 - (1 + rate / 1200.0) ** -term), 2),
+        'grade': sub_grade[0],
+        'subGrade': sub_grade,
+        'empLength': rng.choice([None, 0, 12, 24, 60, 120]),
+        'homeOwnership': rng.choice(HOME),
+        'annualInc': float(rng.randrange(20000, 250000, 500)),
+        'isIncV': rng.choice(['NOT_VERIFIED', 'SOURCE_VERIFIED', 'VERIFIED']),
+        'acceptD': '2016-03-14T12:00:00.000-07:00',
+        'expD': '2016-03-28T12:00:00.000-07:00',
+        'listD': '2016-03-14T14:00:00.000-07:00',
+        'creditPullD': '2016-03-14T11:58:00.000-07:00',
+        'reviewStatusD': '2016-03-14T12:01:00.000-07:00',
+        'reviewStatus': 'APPROVED',
+        'desc': None,
+        'purpose': rng.choice(PURPOSES),
+        'addrZip': '%03dxx' % (rng.randrange(1000)),
+        'addrState': rng.choice(STATES),
+        'investorCount': None,
+        'ilsExpD': None,
+        'initialListStatus': rng.choice(['F', 'W']),
+        'empTitle': rng.choice([None, 'Teacher', 'Manager', 'Registered Nurse', 'Engineer', 'Driver']),
+        'dti': round(rng.uniform(0, 35), 2),
+        'earliestCrLine': '%d-%02d-01T00:00:00.000-08:00' % (rng.randint(1970, 2010), rng.randint(1, 12)),
+        'ficoRangeLow': rng.randrange(660, 845, 5),
+        'revolBal': float(rng.randrange(0, 60000)),
+        'revolUtil': round(rng.uniform(0, 100), 1),
+        'bcUtil': round(rng.uniform(0, 100), 1),
+        'bcOpenToBuy': rng.randrange(0, 40000),
+        'percentBcGt75': round(rng.uniform(0, 100), 1),
+        'pctTlNvrDlq': round(rng.uniform(70, 100), 1),
+        'totHiCredLim': rng.randrange(10000, 500000),
+        'totCurBal': rng.randrange(0, 400000),
+        'avgCurBal': rng.randrange(0, 40000),
+        'totalRevHiLim': rng.randrange(1000, 100000),
+        'totCollAmt': rng.choice([0, 0, 0, rng.randrange(1, 5000)]),
+        'moSinOldIlAcct': rng.randrange(1, 300),
+        'moSinOldRevTlOp': rng.randrange(1, 500),
+        'moSinRcntRevTlOp': rng.randrange(0, 60),
+        'moSinRcntTl': rng.randrange(0, 60),
+        'mthsSinceRecentBc': rng.randrange(0, 100),
+    }
+    loan['ficoRangeHigh'] = loan['ficoRangeLow'] + 4
+    for field in COUNT_FIELDS:
+        loan[field] = min(rng.randrange(0, 8), rng.randrange(0, 30))
+    for field in OPTIONAL_MONTH_FIELDS:
+        loan[field] = rng.choice([None, rng.randrange(0, 120)])
+    return loan
+
+
+def listing(count, seed=0):
+    """Return a listing API response body holding `count` loans."""
+    rng = random.Random(seed)
+    return {'asOfDate': '2016-03-14T14:00:00.000-07:00',
+            'loans': [listing_loan(rng, 60000000 + i) for i in range(count)]}
+
+
+def detailed_notes(count, seed=0):
+    """Return `count` detailed owned notes."""
+    rng = random.Random(seed)
+    notes = []
+    for i in range(count):
+        sub_grade = _sub_grade(rng)
+        amount = float(rng.randrange(1000, 35001, 25))
+        status = rng.choice(NOTE_STATUSES)
+        notes.append(Loan.DetailedOwnedNote({
+            'loanId': 50000000 + i,
+            'noteId': 90000000 + i,
+            'orderId': 70000000 + i // 10,
+            'loanAmount': amount,
+            'noteAmount': 25.0,
+            'purpose': rng.choice(PURPOSES),
+            'grade': sub_grade,
+            'interestRate': _rate(sub_grade),
+            'loanLength': rng.choice([36, 60]),
+            'loanStatus': status,
+            'loanStatusDate': '2016-%02d-01T00:00:00.000-08:00' % (rng.randint(1, 12)),
+            'paymentsReceived': round(rng.uniform(0, 30), 2),
+            'principalPending': 0.0 if status in ('Fully Paid', 'Charged Off') else round(rng.uniform(0, 25), 2),
+        }))
+    return notes
+
+
+LOAN_STATS_FIELDS = ['id', 'member_id', 'loan_amnt', 'funded_amnt', 'term', 'int_rate', 'installment', 'grade',
+                     'sub_grade', 'emp_title', 'emp_length', 'home_ownership', 'annual_inc', 'verification_status',
+                     'issue_d', 'loan_status', 'desc', 'purpose', 'addr_state', 'dti', 'delinq_2yrs',
+                     'inq_last_6mths', 'mths_since_last_delinq', 'open_acc', 'pub_rec', 'revol_bal', 'revol_util',
+                     'total_acc', 'total_pymnt', 'total_rec_prncp', 'total_rec_int', 'recoveries', 'last_pymnt_d']
+
+
+def loan_stats_row(rng, loan_id):
+    """Return one LoanStats row as a list of strings, in LOAN_STATS_FIELDS order."""
+    sub_grade = _sub_grade(rng)
+    amount = rng.randrange(1000, 35001, 25)
+    term = rng.choice([36, 36, 60])
+    rate = _rate(sub_grade)
+    installment = amount * (rate / 1200.0) / (1 - (1 + rate / 1200.0) ** -term)
+    year = rng.randint(2008, 2015)
+    month = rng.randrange(12)
+
+    # Riskier grades charge off more often, and earlier
+    if rng.random() < 0.04 + 0.035 * GRADES.index(sub_grade[0]):
+        status, paid_months = 'Charged Off', rng.randint(0, term // 2)
+    elif rng.random() < 0.8:
+        status, paid_months = 'Fully Paid', rng.randint(6, term)
+    else:
+        status, paid_months = 'Current', rng.randint(0, term - 1)
+    total_pymnt = installment * paid_months if status != 'Fully Paid' else amount * (1 + rate / 200.0)
+    principal = min(amount, total_pymnt * 0.7) if status != 'Fully Paid' else amount
+    last = month + paid_months
+    last_pymnt_d = '%s-%d' % (MONTHS[last % 12], year + last // 12) if paid_months else ''
+    desc = rng.choice(['', '', '', 'Borrower added on %d/01/%d > Consolidating, "high interest" cards' % (month + 1, year),
+                       'Paying off debt.\nThanks for looking'])
+
+    return [str(loan_id), str(loan_id + 1000000), str(amount), str(amount), ' %d months' % (term), ' %.2f%%' % (rate),
+            '%.2f' % (installment), sub_grade[0], sub_grade,
+            rng.choice(['', 'Teacher', 'Manager', 'Registered Nurse', 'Engineer, Senior']),
+            rng.choice(['< 1 year', '1 year', '5 years', '10+ years', 'n/a']), rng.choice(HOME),
+            '%.1f' % (rng.randrange(20000, 250000, 500)), rng.choice(['Not Verified', 'Source Verified', 'Verified']),
+            '%s-%d' % (MONTHS[month], year), status, desc, rng.choice(PURPOSES), rng.choice(STATES),
+            '%.2f' % (rng.uniform(0, 35)), str(min(rng.randrange(0, 5), rng.randrange(0, 5))),
+            str(min(rng.randrange(0, 8), rng.randrange(0, 8))), rng.choice(['', str(rng.randrange(0, 120))]),
+            str(rng.randrange(1, 40)), str(min(rng.randrange(0, 3), rng.randrange(0, 3))),
+            str(rng.randrange(0, 60000)), '%.1f%%' % (rng.uniform(0, 100)), str(rng.randrange(2, 80)),
+            '%.2f' % (total_pymnt), '%.2f' % (principal), '%.2f' % (total_pymnt - principal), '0.0', last_pymnt_d]
+
+
+def write_loan_stats(path, rows, seed=0):
+    """Write a LoanStats CSV with `rows` loans, streaming it so millions of rows don't need the memory."""
+    rng = random.Random(seed)
+    with open(path, 'w', newline='') as handle:
+        writer = csv.writer(handle, quoting=csv.QUOTE_ALL, lineterminator='\n')
+        writer.writerow(LOAN_STATS_FIELDS)
+        for i in range(rows):
+            writer.writerow(loan_stats_row(rng, 1000 + i))
+    return path
+
+
+class FakeResponse(object):
+    'Just enough of a requests.Response for Investor.'
+
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+
+class FakeSession(object):
+    'Serves a canned body for every GET, without touching the network.'
+
+    def __init__(self, content):
+        self.content = content
+
+    def get(self, url):
+        return FakeResponse(self.content)
+
+    def close(self):
+        pass
+
+
+@contextlib.contextmanager
+def _quiet():
+    stdout = sys.stdout
+    sys.stdout = open(os.devnull, 'w')
+    try:
+        yield
+    finally:
+        sys.stdout.close()
+        sys.stdout = stdout
+
+
+class Benchmarks(object):
+    """
+    The benchmarks, sharing one set of synthetic data. Each bench_ method returns a zero argument
+    function to time, and the number of items it handles.
+    """
+
+    def __init__(self, listings=1000, rows=100000, notes=2000, seed=0):
+        self.seed = seed
+        self.dir = tempfile.mkdtemp(prefix='lenderbot-bench-')
+        self.listing = listing(listings, seed)
+        self.listing_loans = [Loan.InFundingLoan(raw) for raw in self.listing['loans']]
+        self.notes = detailed_notes(notes, seed)
+        self.rows = rows
+        self.history = None
+        self.stores = []
+        self.rules = lenderbot.lenderbot_get_config(EXAMPLE_CONFIG, lenderbot.FILTERS_CFG)['filters']
+
+    def close(self):
+        for store in self.stores:
+            store.close()
+        shutil.rmtree(self.dir, ignore_errors=True)
+
+    def _history(self):
+        if self.history is None:
+            self.history = write_loan_stats(os.path.join(self.dir, 'LoanStats.csv'), self.rows, self.seed)
+        return self.history
+
+    def bench_filter_apply(self):
+        filters = [LoanFilter.BasicFilter(rule) for rule in self.rules]
+        loans = self.listing_loans
+
+        def run():
+            for f in filters:
+                for loan in loans:
+                    f.apply(loan)
+        return run, len(filters) * len(loans)
+
+    def bench_filter_mask(self):
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter(rule) for rule in self.rules], processes=1)
+        return (lambda: filters.mask(self.listing_loans)), len(self.listing_loans)
+
+    def bench_apply_filters(self):
+        # A LenderBot with just what __apply_filters needs: the example filters and a note store
+        bot = lenderbot.LenderBot.__new__(lenderbot.LenderBot)
+        bot.filters = LoanFilter.FilterSet([LoanFilter.BasicFilter(rule) for rule in self.rules], processes=1)
+        bot.my_notes = NoteStore.NoteStore(os.path.join(self.dir, 'notes.db'))
+        bot.my_notes.add([{'loanId': loan['id']} for loan in self.listing['loans'][::10]])
+        self.stores.append(bot.my_notes)
+        apply_filters = bot._LenderBot__apply_filters
+        return (lambda: apply_filters(self.listing_loans)), len(self.listing_loans)
+
+    def bench_get_loans(self):
+        investor = Investor.Investor('1', 'key', rate=1e9, burst=1000000, endpoint_root='http://localhost/')
+        investor.session = FakeSession(json.dumps(self.listing).encode('utf-8'))
+        return investor.get_loans, len(self.listing['loans'])
+
+    def bench_history_ingest(self):
+        path = self._history()
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1, chunksize=4096)
+        return (lambda: LoanHistory.LoanHistory(filters, [path], stereoColumns=[])), self.rows
+
+    def bench_history_profile(self):
+        # Ingestion plus a profile of every column, as LoanHistory's -t option does
+        path = self._history()
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1, chunksize=4096)
+        return (lambda: LoanHistory.LoanHistory(filters, [path], stereoColumns=None)), self.rows
+
+    def bench_history_cached(self):
+        path = self._history()
+        cache_dir = os.path.join(self.dir, 'cache')
+        os.makedirs(cache_dir, exist_ok=True)
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1)
+        # Build the cache outside of the timed runs
+        LoanHistory.LoanHistory(filters, [path], cache=True, cacheDir=cache_dir, stereoColumns=[])
+        return (lambda: LoanHistory.LoanHistory(filters, [path], cache=True, cacheDir=cache_dir, stereoColumns=[])), \
+            self.rows
+
+    def _past_loans(self):
+        rng = random.Random(self.seed)
+        rows = [loan_stats_row(rng, i) for i in range(min(self.rows, 100000))]
+        issue, last = LOAN_STATS_FIELDS.index('issue_d'), LOAN_STATS_FIELDS.index('last_pymnt_d')
+        return [(row[issue], row[last] or row[issue]) for row in rows]
+
+    def bench_calc_age(self):
+        loans = [Loan.PastLoan('xkey', 'xval', {'id': i, 'issue_d': issue, 'last_pymnt_d': last})
+                 for i, (issue, last) in enumerate(self._past_loans())]
+
+        def run():
+            for loan in loans:
+                loan._calcAge()
+        return run, len(loans)
+
+    def bench_loan_ages(self):
+        dates = self._past_loans()
+        issued = np.array([issue for issue, _ in dates])
+        last = np.array([last for _, last in dates])
+        return (lambda: Loan.loan_ages(issued, last)), len(dates)
+
+    def bench_note_summary(self):
+        bot = lenderbot.LenderBot.__new__(lenderbot.LenderBot)
+        bot.logger = lenderbot.logging.getLogger('bench')
+        return (lambda: bot.note_summary(notes=self.notes)), len(self.notes)
+
+    def names(self):
+        return [name[len('bench_'):] for name in sorted(dir(self)) if name.startswith('bench_')]
+
+    def run(self, name, repeat=3):
+        fn, items = getattr(self, 'bench_' + name)()
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            with _quiet():
+                fn()
+            times.append(time.perf_counter() - start)
+        best = min(times)
+        return {
+            'items': items,
+            'seconds': best,
+            'median': statistics.median(times),
+            'per_item': best / items if items else 0.0,
+            'items_per_second': items / best if best else None,
+        }
+
+
+def compare(results, baseline, threshold=0.25):
+    """Return (name, baseline per item, current per item, change) for every benchmark slower than threshold."""
+    regressions = []
+    for name, res in sorted(results['results'].items()):
+        base = baseline.get('results', {}).get(name)
+        if base is None or not base['per_item']:
+            continue
+        change = res['per_item'] / base['per_item'] - 1
+        if change > threshold:
+            regressions.append((name, base['per_item'], res['per_item'], change))
+    return regressions
+
+
+def run_all(names=None, repeat=3, **sizes):
+    bench = Benchmarks(**sizes)
+    try:
+        results = {}
+        for name in names or bench.names():
+            results[name] = bench.run(name, repeat)
+            print ('%-16s %10d items %10.4f s %14.0f items/s' % (name, results[name]['items'], results[name]['seconds'],
+                                                              results[name]['items_per_second'] or 0))
+    finally:
+        bench.close()
+    return {
+        'meta': {
+            'timestamp': time.time(),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+            'sizes': sizes,
+            'repeat': repeat,
+        },
+        'results': results,
+    }
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark lenderbot against synthetic data.')
+    parser.add_argument('-b', '--baseline', action='store',
+                        help='Results of an earlier run. Flag benchmarks that got slower.')
+    parser.add_argument('-l', '--listings', action='store', type=int, default=1000,
+                        help='Number of loans in the synthetic listing.')
+    parser.add_argument('-n', '--notes', action='store', type=int, default=2000,
+                        help='Number of synthetic owned notes.')
+    parser.add_argument('-o', '--output', action='store',
+                        help='Write results to this JSON file.')
+    parser.add_argument('-r', '--rows', action='store', type=int, default=100000,
+                        help='Number of rows in the synthetic LoanStats file.')
+    parser.add_argument('-s', '--seed', action='store', type=int, default=0,
+                        help='Seed for the synthetic data.')
+    parser.add_argument('-t', '--threshold', action='store', type=float, default=0.25,
+                        help='Slowdown, per item, that counts as a regression (0.25 = 25%%).')
+    parser.add_argument('--repeat', action='store', type=int, default=3,
+                        help='Runs per benchmark. The best is reported.')
+    parser.add_argument('benchmarks', nargs='*',
+                        help='Benchmarks to run (default: all).')
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+    results = run_all(args.benchmarks, args.repeat, listings=args.listings, rows=args.rows,
+                      notes=args.notes, seed=args.seed)
+    if args.output:
+        with open(args.output, 'w') as handle:
+            json.dump(results, handle, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as handle:
+            regressions = compare(results, json.load(handle), args.threshold)
+        for name, before, after, change in regressions:
+            print ('REGRESSION %s: %.3g -> %.3g s per item (%+.0f%%)' % (name, before, after, 100 * change))
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
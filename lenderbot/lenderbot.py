@@ -1,17 +1,26 @@
 #!/usr/bin/env python3
 
+import asyncio
 from datetime import datetime
 import json
 import logging.config
 import os
 
+from lenderbot import AsyncInvestor
 from lenderbot import Investor
 from lenderbot import LoanFilter
+from lenderbot import NoteSnapshot
+from lenderbot import NoteStore
+from lenderbot import NoteSummary
+from lenderbot import Scheduler
 
 DEFAULT_CFG_DIR = os.path.join(os.path.expanduser('~'), '.lenderbot')
 EXECUTION_CFG = 'config.json'
 LOGGER_CFG = 'logging.json'
 FILTERS_CFG = 'filters.json'
+FILTER_STATS = 'filter_stats.json'
+NOTE_STORE = 'notes.db'
+NOTE_SNAPSHOT = 'detailed_notes.json'
 PRODUCTION_MODE_WARNING = '''Entering production mode. lenderbot may invest in loans or transfer money into your lending account according to your configuration.'''
 
 def lenderbot_get_config_dir(config_dir):
@@ -44,15 +53,50 @@ def lenderbot_init_filters(config_dir):
     if 'filters' in cfg:
         for rule in cfg['filters']:
             filters.append(LoanFilter.BasicFilter(rule))
-    return filters
+    filter_set = LoanFilter.FilterSet(filters,
+                                      processes=cfg.get('processes', 1),
+                                      chunksize=cfg.get('chunksize', 256))
+    filter_set.load_stats(os.path.join(lenderbot_get_config_dir(config_dir), FILTER_STATS))
+    return filter_set
+
+def lenderbot_save_filter_stats(config_dir, filters):
+    filters.save_stats(os.path.join(lenderbot_get_config_dir(config_dir), FILTER_STATS))
 
 def lenderbot_init_driver(cfg, production_mode):
     # Eventually we'll support multiple driver types, but for now
     # we only support LendingClub
+    connection = cfg.get('connection', {})
     return Investor.Investor(cfg['account']['iid'],
                              cfg['account']['auth'],
                              invest_amt=cfg['account']['orderamnt'],
-                             production_mode=production_mode)
+                             production_mode=production_mode,
+                             pool_size=connection.get('pool_size', 4),
+                             rate=connection.get('rate', 1.0),
+                             burst=connection.get('burst', 4))
+
+def lenderbot_init_note_store(config_dir, driver):
+    store = NoteStore.NoteStore(os.path.join(lenderbot_get_config_dir(config_dir), NOTE_STORE))
+    if store.last_refresh() is None:
+        # Nothing to go on yet. Wait for the first sync so we don't buy notes we already own.
+        store.refresh(driver)
+    else:
+        store.refresh_async(driver)
+    return store
+
+def lenderbot_init_snapshot(config_dir, cfg):
+    if 'snapshot' not in cfg:
+        return None
+    return NoteSnapshot.NoteSnapshot(os.path.join(lenderbot_get_config_dir(config_dir), NOTE_SNAPSHOT),
+                                     ttl=cfg['snapshot'].get('ttl', 3600))
+
+def lenderbot_init_scheduler(cfg):
+    if 'schedule' not in cfg:
+        return None
+    schedule = cfg['schedule']
+    return Scheduler.ListingScheduler(schedule['release_times'],
+                                      lead_seconds=schedule.get('lead_seconds', 10),
+                                      window_seconds=schedule.get('window_seconds', 60),
+                                      timezone=schedule.get('timezone'))
 
 def lenderbot_get_portfolio(cfg):
     if 'portfolio' in cfg['account']:
@@ -63,107 +107,173 @@ class LenderBot:
     """Automated investing for your P2P lending accounts."""
 
     def __init__(self, config_dir=None, production_mode=True):
+        self.config_dir = config_dir
         self.config = lenderbot_init_config(config_dir)
         self.logger = lenderbot_init_logger(config_dir)
         self.filters = lenderbot_init_filters(config_dir)
         self.driver = lenderbot_init_driver(self.config, production_mode)
-        self.my_note_ids = [x['loanId'] for x in self.driver.get_notes_owned()]
+        # Connect now, so the first request of a cycle doesn't pay for the handshake
+        self.driver.warm_connection()
+        # Independent requests are sent together through worker clones of the driver
+        self.async_driver = AsyncInvestor.AsyncInvestor(self.driver)
+        self.scheduler = lenderbot_init_scheduler(self.config)
+        self.snapshot = lenderbot_init_snapshot(config_dir, self.config)
+        self.my_notes = lenderbot_init_note_store(config_dir, self.driver)
         if production_mode:
             self.logger.warning(PRODUCTION_MODE_WARNING)
         self.logger.info('Adding %d filter(s)', len(self.filters))
         self.logger.info('LenderBot initialization complete')
 
-    def __apply_filters(self, loans):
+    def close(self):
+        """Wait for any note store sync, then close the note store, filter workers and API connection pool."""
+        self.my_notes.close()
+        self.filters.close()
+        self.async_driver.close()
+        self.driver.close()
+
+    def __apply_filters(self, loans, seen=None):
         # First, filter out loans we already own
-        loans = [loan for loan in loans if loan['id'] not in self.my_note_ids]
+        loans = [loan for loan in loans if loan['id'] not in self.my_notes]
 
-        # Second, apply user defined filters
-        for f in self.filters:
-            loans = [loan for loan in loans if f.apply(loan)]
-        return loans
+        # Second, apply user defined filters. Reuse verdicts for loans we've already seen.
+        mask = seen.mask(loans) if seen is not None else self.filters.mask(loans)
+        return [loan for loan, passed in zip(loans, mask) if passed]
+
+    async def __gather_account_state(self):
+        # These requests are independent, so send them without waiting on each other's responses
+        driver = self.async_driver
+
+        async def no_notes():
+            return None
+
+        return await asyncio.gather(
+            # The note snapshot fetches detailed notes itself, and only when it has expired
+            driver.get_detailed_notes_owned() if self.snapshot is None else no_notes(),
+            driver.get_portfolio(lenderbot_get_portfolio(self.config), create=True),
+            driver.get_cash(),
+            driver.get_pending_transfers())
 
     def run(self):
-        self.find_late_notes()
-        self.invest()
-        self.fund_account()
-
-    def note_summary(self, late_only=False, include_closed=False):
-        # TODO: Revisit this
-        # Get full list of owned notes
-        notes = self.driver.get_detailed_notes_owned()
-
-        # Separate out notes by status
-        current = [note for note in notes if note.is_current()]
-        late = [note for note in notes if note.is_late()]
-        opened = [note for note in notes if note.is_open()]
-        closed = [note for note in notes if not note.is_open()]
-        review = [note for note in notes if not note.is_issued()]
-
-        summary = ''
-        if late_only:
-            summary = '%d late note(s)' % (len(late))
-            for note in late:
-                summary += '\n%s' % (note)
+        loop = asyncio.new_event_loop()
+        try:
+            notes, portfolio, cash, xfers = loop.run_until_complete(self.__gather_account_state())
+        finally:
+            loop.close()
+
+        self.find_late_notes(notes=notes)
+        purchased_loans = self.invest(portfolio=portfolio, available_cash=cash)
+        # Cash needs to be re-read if we just spent some of it
+        self.fund_account(cash=None if purchased_loans else cash, xfers=xfers)
 
+    def note_stats(self, include_closed=False, notes=None):
+        """Summarize owned notes in a single pass. Returns a NoteSummary."""
+        if notes is None:
+            if self.snapshot is not None:
+                notes = self.snapshot.notes(self.driver)
+            else:
+                # Stream notes straight into the summary
+                notes = self.driver.iter_detailed_notes_owned()
+        return NoteSummary.NoteSummary(include_closed).update(notes)
+
+    def note_summary(self, late_only=False, include_closed=False, notes=None):
+        stats = self.note_stats(include_closed=include_closed, notes=notes)
+        if late_only:
+            summary = stats.late_text()
         else:
-            summary_notes = opened
-            if include_closed:
-                summary_notes += len(closed)
-            avg_rate = sum(x['interestRate'] for x in summary_notes) / len(summary_notes)
-            summary = '%d note(s) owned at an average interest rate of %.2f%%\n' % (len(summary_notes), avg_rate)
-            summary += '%d open note(s):\n' % (len(opened))
-            summary += '  %d current note(s)\n' % (len(current))
-            if include_closed:
-                summary += '  %d closed note(s)\n' % (len(closed))
-            summary += '  %d late note(s)\n' % (len(late))
-            summary += '  %d note(s) in review\n' % (len(review))
-            grade_summary = '  Grades - '
-            grades = ['A', 'B', 'C', 'D', 'E', 'F', 'G']
-            for grade in grades:
-                grade_summary += '%c: %d  ' % (grade, len([n for n in summary_notes if grade in n['grade']]))
-            summary += grade_summary
+            summary = stats.text()
 
         self.logger.info(summary)
         return summary
 
-    def find_late_notes(self):
-        summary = self.note_summary(late_only=True)
+    def find_late_notes(self, notes=None):
+        if notes is None and self.snapshot is not None and self.config['snapshot'].get('changes_only', False):
+            # Only report notes whose status changed since we last looked
+            notes = self.snapshot.pop_changed(self.driver)
+        summary = self.note_summary(late_only=True, notes=notes)
         return summary
 
-    def invest(self):
-        """Invest in newly listed loans that pass filters."""
-        portfolio = self.driver.get_portfolio(lenderbot_get_portfolio(self.config), create=True)
-        available_cash = self.driver.get_cash()
-        invest_amount = self.config['account']['orderamnt']
+    def invest(self, portfolio=None, available_cash=None):
+        """
+        Invest in newly listed loans that pass filters. Returns the successfully ordered notes.
+        The portfolio and available cash are looked up unless prefetched values are passed in.
+        """
+        if available_cash is None:
+            portfolio = self.driver.get_portfolio(lenderbot_get_portfolio(self.config), create=True)
+            available_cash = self.driver.get_cash()
+        order = self.driver.stage_order(portfolio, available_cash)
 
         # Find loans that pass filters
         loans = []
+        seen = LoanFilter.SeenLoanIndex(self.filters)
         self.logger.info('Retrieving new loans')
         for _ in range(1, 140):
             loans = self.driver.get_loans()
-            loans = self.__apply_filters(loans)
+            loans = self.__apply_filters(loans, seen)
             if len(loans):
                 break
 
-        # Purchase as many loans as we can
-        num_loans = int(min(available_cash/invest_amount, len(loans)))
-        purchased_loans = self.driver.submit_order(loans[:num_loans], portfolio)
+        purchased_loans = self.__purchase(loans, order)
+        lenderbot_save_filter_stats(self.config_dir, self.filters)
+        # TODO: Database stuff
+        return purchased_loans
+
+    def __purchase(self, loans, order):
+        # Purchase as many loans as we can. The staged order knows how many we can afford.
+        purchased_loans = self.driver.submit_staged_order(order, loans)
+        self.my_notes.add_confirmations(purchased_loans)
 
         # Book keeping
         self.logger.info('%d loan(s) pass filters', len(loans))
         if len(loans) > 0:
             self.logger.info('%d loan(s) succesfully purchased', len(purchased_loans))
-        # TODO: Database stuff
+        return purchased_loans
+
+    def invest_at_release(self):
+        """
+        Wait for the next scheduled listing release, then poll as fast as the API allows for the
+        configured window, ordering loans that pass filters as they appear. Returns the
+        successfully ordered notes.
+        """
+        if self.scheduler is None:
+            self.logger.error('No listing schedule configured. Add a \'schedule\' section to %s', EXECUTION_CFG)
+            return []
+        release = self.scheduler.next_release()
+        self.scheduler.wait_for(release)
+
+        # Get everything we need to place an order out of the way before loans are listed
+        self.driver.warm_connection()
+        portfolio = self.driver.get_portfolio(lenderbot_get_portfolio(self.config), create=True)
+        order = self.driver.stage_order(portfolio, self.driver.get_cash())
+
+        seen = LoanFilter.SeenLoanIndex(self.filters)
+        first_seen = {}
+        purchased_loans = []
+        self.logger.info('Polling for loans released at %s', release.strftime('%H:%M'))
+        while self.scheduler.window_open(release):
+            loans = self.__apply_filters(self.driver.get_loans(), seen)
+            new_loans = [loan for loan in loans if loan['id'] not in first_seen]
+            for loan in new_loans:
+                first_seen[loan['id']] = self.scheduler.seconds_since(release)
+                self.logger.info('Loan %s first seen %.1f second(s) after release', loan['id'], first_seen[loan['id']])
+            if new_loans and order.remaining > 0:
+                purchased_loans += self.__purchase(new_loans, order)
+
+        self.logger.info('%d loan(s) passed filters within %d second(s) of release',
+                         len(first_seen), self.scheduler.window.total_seconds())
+        lenderbot_save_filter_stats(self.config_dir, self.filters)
+        return purchased_loans
 
-    def fund_account(self):
+    def fund_account(self, cash=None, xfers=None):
         min_balance = self.config['account']['min_balance']
         transfer_multiple = 25
-        cash = self.driver.get_cash()
+        if cash is None:
+            cash = self.driver.get_cash()
         if cash >= min_balance:
             return
 
         # Sum pending transfers amounts
-        xfers = self.driver.get_pending_transfers()
+        if xfers is None:
+            xfers = self.driver.get_pending_transfers()
         pending_xfer_amt = sum([x['amount'] for x in xfers])
 
         # Transfer additional funds if cash + pending transfers < min_balance
@@ -184,5 +294,12 @@ class LenderBot:
                     f.apply(l)
             except:
                 self.logger.error('Filter (%s) FAILED', f)
+        try:
+            # Every listed loan is a good sample of how selective each filter is
+            self.filters.sample(loans)
+            lenderbot_save_filter_stats(self.config_dir, self.filters)
+        except (KeyError, OSError, ValueError) as e:
+            self.logger.error('Unable to record filter statistics: %s', e)
+        self.logger.info('Filter evaluation order: %s', self.filters)
         self.logger.info('Loan filter testing complete')
 
@@ -1,6 +1,7 @@
 #!/usr/bin/env python3
 
 import argparse
+from lenderbot import Backtest
 from lenderbot import lenderbot
 
 def parse_args():
@@ -8,6 +9,11 @@ def parse_args():
     parser.add_argument('-a', '--autoMode',
                         action='store_true',
                         help='Enter auto-mode. Check notes, fund account, and invest in available loans.')
+    parser.add_argument('-b', '--backtest',
+                        action='store',
+                        nargs='+',
+                        metavar='FILE',
+                        help='Backtest loan filters against LendingClub history (LoanStats) CSV files. Exit once complete.')
     parser.add_argument('-c', '--configDir',
                         action='store',
                         help='Specify a non-default configuration directory.')
@@ -23,6 +29,9 @@ def parse_args():
     parser.add_argument('-p', '--productionMode',
                         action='store_true',
                         help='Enter production mode. Required to invest or transfer funds.')
+    parser.add_argument('-r', '--releaseMode',
+                        action='store_true',
+                        help='Wait for the next scheduled listing release, then invest in loans passing filters.')
     parser.add_argument('-s', '--summarizeNotes',
                         action='store_true',
                         help='Provide status summary of all held notes.')
@@ -33,19 +42,28 @@ def parse_args():
 
 def main():
     args = parse_args()
+    if args.backtest:
+        # Only needs filters.json, not account credentials
+        print(Backtest.backtest(args.configDir, args.backtest, cache=True).text())
+        return
     lb = lenderbot.LenderBot(config_dir=args.configDir, production_mode=args.productionMode)
-    if args.autoMode:
-        lb.run()
-    if args.fundAccount:
-        lb.fund_account()
-    if args.invest:
-        lb.invest()
-    if args.findLate:
-        lb.find_late_notes()
-    if args.summarizeNotes:
-        lb.note_summary()
-    if args.testFilters:
-        lb.test_filters()
+    try:
+        if args.autoMode:
+            lb.run()
+        if args.fundAccount:
+            lb.fund_account()
+        if args.invest:
+            lb.invest()
+        if args.releaseMode:
+            lb.invest_at_release()
+        if args.findLate:
+            lb.find_late_notes()
+        if args.summarizeNotes:
+            lb.note_summary()
+        if args.testFilters:
+            lb.test_filters()
+    finally:
+        lb.close()
 
 if __name__ == '__main__':
     main()
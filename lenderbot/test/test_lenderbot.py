@@ -1,15 +1,778 @@
 #!/usr/bin/env python3
 
+import asyncio
+from datetime import datetime, timedelta
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+import logging
+import os
+import pickle
+from socketserver import ThreadingMixIn
 import sys
+import tempfile
+import threading
+import time
 
+import numpy as np
+
+from lenderbot import AsyncInvestor
+from lenderbot import Backtest
+from lenderbot import Investor
 from lenderbot import lenderbot
+from lenderbot import Loan
+from lenderbot import ColumnFilter
+from lenderbot import HistoryCache
+from lenderbot import HistorySchema
+from lenderbot import LoanFilter
+from lenderbot import LoanHistory
+from lenderbot import NoteSnapshot
+from lenderbot import NoteStore
+from lenderbot import NoteSummary
+from lenderbot import RateLimiter
+from lenderbot import Scheduler
+from lenderbot import Sketch
+from lenderbot import Sweep
 import unittest
 
+EXAMPLE_CONFIG = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'example_config')
+
 
 class LenderbotTest(unittest.TestCase):
     def test_dummy_test(self):
         self.assertTrue(True)
 
 
+class LoanFilterTest(unittest.TestCase):
+    def test_compiled_filter_reused_across_loans(self):
+        f = LoanFilter.BasicFilter('{grade} >= D')
+        self.assertTrue(f.apply({'grade': 'E'}))
+        self.assertFalse(f.apply({'grade': 'B'}))
+
+    def test_string_values_converted_like_literals(self):
+        # Values read from CSV files are strings
+        self.assertTrue(LoanFilter.BasicFilter('{id} > 0').apply({'id': '123'}))
+        self.assertTrue(LoanFilter.BasicFilter('{paramB} == None').apply({'paramB': 'None'}))
+
+    def test_baseline_semantics_for_bools_and_bare_names(self):
+        # Rules used to be evaluated by writing str(value) into them, with no bare names defined
+        loans = [{'a': True, 'b': False, 'term': 36}, {'a': 1, 'b': 0, 'term': 60}]
+        expected = {
+            '{a} == True': [True, False],
+            '{a} == 1': [False, True],
+            '{b} == False': [True, False],
+            '{b} == 0': [False, True],
+            'term == 36': [False, False],
+            'term == term': [True, True],
+        }
+        batch = ColumnFilter.LoanBatch(loans)
+        for rule, results in expected.items():
+            f = LoanFilter.BasicFilter(rule)
+            self.assertEqual([f.apply(loan) for loan in loans], results, rule)
+            self.assertEqual(f.mask(batch).tolist(), results, rule)
+        self.assertEqual(LoanFilter.BasicFilter('term == 36').keys(), set())
+
+    def test_none_fails_comparison(self):
+        self.assertFalse(LoanFilter.BasicFilter('{paramA} < 10').apply({'paramA': None}))
+
+    def test_filter_set_mask_matches_per_loan(self):
+        loans = [{'term': t, 'grade': g} for t in (36, 60) for g in 'ABCDEFG']
+        filters = [LoanFilter.BasicFilter('{term} == 36'), LoanFilter.BasicFilter('{grade} >= D')]
+        expected = [all(f.apply(loan) for f in filters) for loan in loans]
+
+        inline = LoanFilter.FilterSet(filters, processes=1)
+        self.assertEqual(inline.mask(loans), expected)
+
+        pooled = LoanFilter.FilterSet(filters, processes=2, chunksize=3)
+        try:
+            self.assertEqual(pooled.mask(loans), expected)
+            self.assertEqual([passed for _, passed in pooled.imap(iter(loans))], expected)
+        finally:
+            pooled.close()
+
+    def test_vectorized_mask_matches_per_loan(self):
+        values = [None, 0, 36, -1, 2.5, 'D', 'G', '36', '15.5', 'None', 'house']
+        loans = [{'a': a, 'b': b} for a in values for b in values]
+        batch = ColumnFilter.LoanBatch(loans)
+        for rule in ['{a} == 36', '{a} >= D', '{a} != None', '{a} != house', '0 < {a} < 40',
+                     '{a} == {b}', '{a}', '50 < 10']:
+            f = LoanFilter.BasicFilter(rule)
+            self.assertEqual(f.mask(batch).tolist(), [bool(f.apply(loan)) for loan in loans], rule)
+
+    def test_arithmetic_evaluated_loan_by_loan(self):
+        loans = [{'a': 'A', 'b': 'B', 'n': 6, 'd': 3}, {'a': 1, 'b': 2, 'n': 6, 'd': 4}]
+        batch = ColumnFilter.LoanBatch(loans)
+        columns = ColumnFilter.LoanBatch(columns=dict((key, batch.column(key)) for key in loans[0]))
+        for rule in ['{a} + {b} == AB', '{a} * 2 == AA', '{n} // {d} == 2', '-{a} == 0', '-5 < {d}']:
+            f = LoanFilter.BasicFilter(rule)
+            expected = [bool(f.apply(loan)) for loan in loans]
+            self.assertEqual(f.mask(batch).tolist(), expected, rule)
+            self.assertEqual(f.mask(columns).tolist(), expected, rule)
+        self.assertTrue(LoanFilter.BasicFilter('-5 < {d}').vectorized)
+        self.assertFalse(LoanFilter.BasicFilter('{n} / {d} > 1').vectorized)
+        # Division by zero raises either way
+        zero = LoanFilter.BasicFilter('{n} / 0 > 1')
+        self.assertRaises(ZeroDivisionError, zero.apply, loans[0])
+        self.assertRaises(ZeroDivisionError, zero.mask, columns)
+
+    def test_filter_set_runs_selective_filters_first(self):
+        loans = [{'term': 36 if i % 10 == 0 else 60, 'grade': 'D'} for i in range(100)]
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{grade} >= D'),
+                                        LoanFilter.BasicFilter('{term} == 36')], processes=1)
+        mask = filters.mask(loans)
+        self.assertEqual(sum(mask), 10)
+        self.assertEqual([str(f) for f in filters], ['{term} == 36', '{grade} >= D'])
+        self.assertEqual(filters.mask(loans), mask)
+
+    def test_sample_records_unconditional_pass_rates(self):
+        loans = [{'term': 36 if i % 10 == 0 else 60, 'grade': 'D' if i % 2 else 'A'} for i in range(100)]
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{term} == 36'),
+                                        LoanFilter.BasicFilter('{grade} >= D')], processes=1)
+        filters.mask(loans)
+        # Only the 10 loans passing the term filter reached the grade filter
+        self.assertEqual(filters.filters[1].pass_count + filters.filters[1].fail_count, 10)
+        filters.sample(loans)
+        self.assertEqual((filters.filters[1].pass_count, filters.filters[1].fail_count), (50, 60))
+
+    def test_seen_loan_index_only_evaluates_new_or_changed_loans(self):
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{term} == 36')], processes=1)
+        self.assertEqual(filters.keys(), {'term'})
+        seen = LoanFilter.SeenLoanIndex(filters)
+        loans = [{'id': 1, 'term': 36, 'desc': 'a'}, {'id': 2, 'term': 60, 'desc': 'b'}]
+        self.assertEqual(seen.mask(loans), [True, False])
+        evaluated = filters.filters[0].pass_count + filters.filters[0].fail_count
+
+        # Unused fields don't matter, filter fields do
+        loans = [{'id': 1, 'term': 36, 'desc': 'x'}, {'id': 2, 'term': 36, 'desc': 'b'}, {'id': 3, 'term': 60}]
+        self.assertEqual(seen.mask(loans), [True, True, False])
+        self.assertEqual(filters.filters[0].pass_count + filters.filters[0].fail_count, evaluated + 2)
+
+
+class RateLimiterTest(unittest.TestCase):
+    def test_token_bucket_waits_only_as_long_as_needed(self):
+        now = [100.0]
+        slept = []
+
+        def sleep(seconds):
+            slept.append(seconds)
+            now[0] += seconds
+
+        bucket = RateLimiter.TokenBucket(rate=2.0, burst=2, clock=lambda: now[0], sleep=sleep)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertEqual(bucket.acquire(), 0)
+        self.assertAlmostEqual(bucket.acquire(), 0.5)
+        now[0] += 0.45
+        self.assertAlmostEqual(bucket.acquire(), 0.05)
+        self.assertEqual(len(slept), 2)
+
+
+class SchedulerTest(unittest.TestCase):
+    def test_next_release(self):
+        now = [datetime(2016, 3, 1, 9, 0, 30)]
+        slept = []
+        scheduler = Scheduler.ListingScheduler(['14:00', '06:00', '10:00'], lead_seconds=5, window_seconds=60,
+                                               now=lambda: now[0], sleep=slept.append)
+        self.assertEqual(scheduler.next_release(), datetime(2016, 3, 1, 10, 0))
+        # Still inside the 06:00 window
+        self.assertEqual(scheduler.next_release(datetime(2016, 3, 1, 6, 0, 59)), datetime(2016, 3, 1, 6, 0))
+        self.assertEqual(scheduler.next_release(datetime(2016, 3, 1, 20, 0)), datetime(2016, 3, 2, 6, 0))
+
+        release = scheduler.next_release()
+        scheduler.wait_for(release)
+        self.assertEqual(slept, [3570.0 - 5])
+        now[0] = datetime(2016, 3, 1, 10, 0, 59)
+        self.assertTrue(scheduler.window_open(release))
+        now[0] = datetime(2016, 3, 1, 10, 1)
+        self.assertFalse(scheduler.window_open(release))
+
+    def test_timezones(self):
+        scheduler = Scheduler.ListingScheduler(['10:00'], timezone='-08:00')
+        self.assertEqual(scheduler.tz.utcoffset(None), timedelta(hours=-8))
+        self.assertEqual(Scheduler.resolve_timezone('UTC+0530').utcoffset(None), timedelta(hours=5, minutes=30))
+        self.assertRaises(ValueError, Scheduler.resolve_timezone, 'Not/AZone')
+
+        # Without zoneinfo, a name is an error rather than silently falling back to local time
+        zoneinfo = Scheduler.ZoneInfo
+        Scheduler.ZoneInfo = None
+        try:
+            self.assertRaises(ValueError, Scheduler.ListingScheduler, ['10:00'], timezone='America/Los_Angeles')
+        finally:
+            Scheduler.ZoneInfo = zoneinfo
+
+
+class LoanTest(unittest.TestCase):
+    def test_past_loan_age(self):
+        issued = ['Jan-2015', 'Jan-2015', 'Dec-2015', 'Mar-2016']
+        paid = ['Jun-2015', 'Jan-2018', 'Jan-2016', 'Feb-2016']
+        ages = [Loan.PastLoan('xkey', 'xval', {'id': '1', 'issue_d': i, 'last_pymnt_d': p}).getAge()
+                for i, p in zip(issued, paid)]
+        self.assertEqual(ages, [5, 36, 1, 0])
+        self.assertEqual(list(Loan.loan_ages(issued, paid)), ages)
+
+    def test_loans_share_schema_and_read_like_dicts(self):
+        a = Loan.PastLoan('xkey', 'xval', {'id': '1', 'grade': 'A'})
+        b = Loan.PastLoan('xkey', 'xval', {'id': '2', 'grade': 'B'})
+        self.assertIs(a._schema, b._schema)
+        self.assertFalse(hasattr(a, '__dict__'))
+        a['loan_age'] = 3
+        self.assertEqual(a['loan_age'], 3)
+        self.assertNotIn('loan_age', b)
+        self.assertEqual(b.get('loan_age', -1), -1)
+        self.assertEqual(dict(b), {'id': '2', 'grade': 'B', 'csv_line': '-1'})
+
+        # Comparisons use quality
+        a.set_quality(50)
+        self.assertTrue(a < b)
+        self.assertEqual(sorted([b, a])[0]['id'], '1')
+
+        # Records survive the trip to filter pool workers
+        c = pickle.loads(pickle.dumps(a))
+        self.assertEqual(c.to_dict(), a.to_dict())
+        self.assertEqual(c.quality, 50)
+        self.assertTrue(c.isValid())
+
+
+class NoteStoreTest(unittest.TestCase):
+    def test_incremental_updates_and_sync(self):
+        path = os.path.join(tempfile.mkdtemp(), 'notes.db')
+        store = NoteStore.NoteStore(path)
+        self.assertIsNone(store.last_refresh())
+        store.replace([{'loanId': 1, 'noteId': 11}, {'loanId': 2, 'noteId': 12}])
+        store.add_confirmations([{'loanId': 3, 'executionStatus': ['ORDER_FULFILLED']}])
+        self.assertIn(3, store)
+        store.close()
+
+        store = NoteStore.NoteStore(path)
+        self.assertEqual(store.loan_ids, {1, 2, 3})
+        self.assertIsNotNone(store.last_refresh())
+        store.replace([{'loanId': 2, 'noteId': 12}, {'loanId': 3, 'noteId': 13}])
+        self.assertNotIn(1, store)
+        self.assertEqual(len(store), 2)
+        store.close()
+
+    def test_notes_bought_during_sync_are_kept(self):
+        store = NoteStore.NoteStore(os.path.join(tempfile.mkdtemp(), 'notes.db'))
+        store.add([{'loanId': 1}, {'loanId': 2}])
+
+        class Driver:
+            def get_notes_owned(self):
+                # Loan 3 is bought after the download started, so it isn't in the list
+                store.add_confirmations([{'loanId': 3}])
+                return [{'loanId': 2, 'noteId': 12}]
+
+        store.refresh(Driver())
+        self.assertEqual(store.loan_ids, {2, 3})
+        store.close()
+        store = NoteStore.NoteStore(store.path)
+        self.assertEqual(store.loan_ids, {2, 3})
+        store.close()
+
+    def test_empty_account_is_synced(self):
+        store = NoteStore.NoteStore(os.path.join(tempfile.mkdtemp(), 'notes.db'))
+
+        class Driver:
+            def get_notes_owned(self):
+                return []
+
+        self.assertEqual(store.refresh(Driver()), 0)
+        self.assertIsNotNone(store.last_refresh())
+        store.close()
+
+
+class NoteSummaryTest(unittest.TestCase):
+    def test_single_pass_summary(self):
+        raw = [('Current', 'A1', 10.0, 500), ('Late (31-120 days)', 'C3', 15.0, 300),
+               ('Fully Paid', 'B2', 12.0, 0), ('In Review', 'D4', 20.0, 1000)]
+        notes = [Loan.DetailedOwnedNote({'loanStatus': status, 'grade': grade, 'interestRate': rate,
+                                         'principalPending': pending})
+                 for status, grade, rate, pending in raw]
+
+        res = NoteSummary.NoteSummary().update(iter(notes)).result()
+        self.assertEqual(res['status'], {'current': 1, 'late': 1, 'open': 3, 'closed': 1, 'review': 1})
+        self.assertEqual(res['summary_notes'], 3)
+        self.assertAlmostEqual(res['average_rate'], 15.0)
+        self.assertEqual(res['grades']['B'], 0)
+        self.assertEqual(res['principal_outstanding'], 1800)
+        self.assertEqual(len(res['late_notes']), 1)
+
+        summary = NoteSummary.NoteSummary(include_closed=True).update(notes)
+        self.assertEqual(summary.result()['summary_notes'], 4)
+        self.assertEqual(summary.result()['sub_grades']['B2'], 1)
+        self.assertIn('1 closed note(s)', summary.text())
+
+
+class FakeNotesDriver:
+    def __init__(self, statuses):
+        self.statuses = statuses
+        self.calls = 0
+
+    def iter_detailed_notes_owned(self):
+        self.calls += 1
+        for note_id, status in enumerate(self.statuses):
+            yield Loan.DetailedOwnedNote({'noteId': note_id, 'loanStatus': status})
+
+
+class NoteSnapshotTest(unittest.TestCase):
+    def test_ttl_and_change_detection(self):
+        path = os.path.join(tempfile.mkdtemp(), 'detailed_notes.json')
+        driver = FakeNotesDriver(['Current', 'Current', 'In Grace Period'])
+        snapshot = NoteSnapshot.NoteSnapshot(path, ttl=3600)
+        self.assertEqual(len(snapshot.pop_changed(driver)), 3)
+        self.assertEqual(snapshot.pop_changed(driver), [])
+        self.assertEqual(len(snapshot.notes(driver)), 3)
+        self.assertEqual(driver.calls, 1)
+
+        # An expired snapshot is downloaded again and only the changed note is reported
+        driver.statuses = ['Current', 'Late (16-30 days)', 'In Grace Period']
+        snapshot = NoteSnapshot.NoteSnapshot(path, ttl=0)
+        changed = snapshot.pop_changed(driver)
+        self.assertEqual([note['noteId'] for note in changed], [1])
+        self.assertEqual(driver.calls, 2)
+
+
+class FakeResponse:
+    def __init__(self, body):
+        self.content = json.dumps(body).encode()
+        self.text = self.content.decode()
+
+
+class FakeSession:
+    'Records requests instead of sending them.'
+
+    def __init__(self, body):
+        self.body = body
+        self.requests = []
+        self.closed = False
+
+    def get(self, url):
+        self.requests.append(('GET', url))
+        return FakeResponse(self.body)
+
+    def post(self, url, data=None):
+        self.requests.append(('POST', url))
+        return FakeResponse(self.body)
+
+    def close(self):
+        self.closed = True
+
+
+class InvestorSessionTest(unittest.TestCase):
+    def test_session_setup(self):
+        investor = Investor.Investor(1, 'auth', pool_size=3, endpoint_root='http://lc.invalid/v1/')
+        self.assertEqual(investor.session.headers['Authorization'], 'auth')
+        self.assertEqual(investor.session.headers['Accept'], 'application/json')
+        self.assertEqual(investor.session.get_adapter(investor.endpoint_root)._pool_maxsize, 3)
+        investor.close()
+
+    def test_requests_use_session_and_close(self):
+        investor = Investor.Investor(1, 'auth', production_mode=True, rate=1000.0, burst=10,
+                                     endpoint_root='http://lc.invalid/v1/')
+        investor.session = FakeSession({'availableCash': 50.0})
+        self.assertEqual(investor.get_cash(), 50.0)
+        investor.add_funds(25)
+        self.assertEqual([method for method, _ in investor.session.requests], ['GET', 'POST'])
+        self.assertTrue(all(url.startswith('http://lc.invalid/v1/') for _, url in investor.session.requests))
+
+        bot = lenderbot.LenderBot.__new__(lenderbot.LenderBot)
+        bot.driver = investor
+        bot.async_driver = AsyncInvestor.AsyncInvestor(investor)
+        bot.my_notes = NoteStore.NoteStore(os.path.join(tempfile.mkdtemp(), 'notes.db'))
+        bot.filters = lenderbot.lenderbot_init_filters(EXAMPLE_CONFIG)
+        # Listings are filtered in-process unless filters.json asks for workers
+        self.assertFalse(bot.filters._use_pool(10000))
+        bot.close()
+        self.assertTrue(investor.session.closed)
+
+
+class StagedOrderTest(unittest.TestCase):
+    def test_payload_matches_json_encoding(self):
+        order = Investor.StagedOrder(1234, 25, portfolio_id=99, cash=60)
+        loans = order.select([{'id': 10}, {'id': 11}, {'id': 12}])
+        self.assertEqual(len(loans), 2)
+        expected = json.dumps({'aid': 1234, 'orders': [{'loanId': l['id'], 'requestedAmount': 25, 'portfolioId': 99}
+                                                       for l in loans]})
+        self.assertEqual(order.payload(loans), expected)
+        self.assertEqual(Investor.StagedOrder(1234, 25).payload([{'id': 10}]),
+                         json.dumps({'aid': 1234, 'orders': [{'loanId': 10, 'requestedAmount': 25}]}))
+
+
+HISTORY_CSV = '''"id","loan_status","issue_d","last_pymnt_d","int_rate","grade"
+"1","Charged Off","Jan-2015","Jun-2015","13.5%","C"
+"2","Fully Paid","Jan-2015","Jan-2018","10.0%","B"
+"3","Current","Mar-2016","","9.0%","A"
+"4","Charged Off","Feb-2014","Mar-2016","18.0%","D"
+'''
+
+
+def write_history(contents=HISTORY_CSV):
+    path = os.path.join(tempfile.mkdtemp(), 'LoanStats.csv')
+    with open(path, 'w') as handle:
+        handle.write(contents)
+    return path
+
+
+class LoanHistoryTest(unittest.TestCase):
+    def test_counts_only_aggregation(self):
+        path = write_history()
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1, chunksize=2)
+        history = LoanHistory.LoanHistory(filters, [path])
+        self.assertEqual(history.Counts['default'], {5: 1, 25: 1})
+        self.assertEqual(history.Counts['good'], {36: 1, 0: 1})
+        self.assertEqual(history.Loans['default'], {})
+
+        history = LoanHistory.LoanHistory(filters, [path], keepLoans=True)
+        self.assertEqual([loan['id'] for loan in history.Loans['default'][5]], [1])
+
+    def test_typed_columns(self):
+        path = write_history()
+        schema = HistorySchema.HistorySchema.sample(path, declared={'grade': 'categorical'})
+        self.assertEqual(schema.types, {'id': 'int', 'loan_status': 'categorical', 'issue_d': 'date',
+                                        'last_pymnt_d': 'date', 'int_rate': 'percent', 'grade': 'categorical'})
+        row = schema.convert({'id': '7', 'int_rate': ' 9.5%', 'issue_d': 'Feb-2016', 'last_pymnt_d': '', 'grade': ''})
+        self.assertEqual(row, {'id': 7, 'int_rate': 9.5, 'issue_d': Loan.month_ordinal('Feb-2016'),
+                               'last_pymnt_d': None, 'grade': None})
+
+        # Percentages compare as numbers, not strings ('9.0%' > '13.5%')
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{int_rate} > 12')], processes=1)
+        history = LoanHistory.LoanHistory(filters, [path], types={'grade': 'categorical'})
+        self.assertEqual(history.Counts, {'default': {5: 1, 25: 1}, 'good': {}})
+
+        # Only columns with a limited set of values are interned
+        rows = [{'grade': 'ABC'[i % 3], 'desc': 'Loan %d' % (i)} for i in range(200)]
+        schema = HistorySchema.HistorySchema.infer(['grade', 'desc'], rows)
+        self.assertEqual(schema.types, {'grade': 'categorical', 'desc': 'text'})
+        self.assertEqual(schema.convert({'grade': 'A', 'desc': ''}), {'grade': 'A', 'desc': None})
+
+    def test_dates_that_did_not_convert(self):
+        # One date doesn't match the column type, so the cached column holds numbers and a string
+        path = write_history(HISTORY_CSV + '"5","Charged Off","Jan-2016","MAR-2016","20.0%","E"\n')
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1)
+        history = LoanHistory.LoanHistory(filters, [path], types={'last_pymnt_d': 'date', 'issue_d': 'date'},
+                                          cache=True)
+        self.assertEqual(history.Counts['default'], {5: 1, 25: 1, 2: 1})
+
+    def test_default_rate_and_survival(self):
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1)
+        history = LoanHistory.LoanHistory(filters, [write_history()])
+        res = history.defaultRate([36, 6, 12], output=False)
+        self.assertEqual((res['total'], res['good']), (4, 2))
+        self.assertEqual([(b['from'], b['to'], b['defaults']) for b in res['buckets']],
+                         [(0, 6, 1), (6, 12, 0), (12, 36, 1), (36, None, 0)])
+        # The loan current at 0 months leaves the risk set before the first default at 5 months
+        self.assertEqual(res['at_risk'][:6], [4, 3, 3, 3, 3, 3])
+        self.assertAlmostEqual(res['hazard'][5], 1 / 3.0)
+        self.assertAlmostEqual(res['buckets'][2]['survival'], 1 / 3.0)
+        self.assertAlmostEqual(res['survival'][-1], 1 / 3.0)
+
+    def test_parallel_chunks_match_serial(self):
+        path = write_history()
+        header, ranges = LoanHistory._splitFile(path, chunkBytes=1)
+        self.assertEqual(header[0], 'id')
+        self.assertEqual(len(ranges), 4)
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1)
+        serial = LoanHistory.LoanHistory(filters, [path, path])
+        parallel = LoanHistory.LoanHistory(filters, [path, path], processes=2, chunkBytes=1)
+        self.assertEqual(parallel.Counts, serial.Counts)
+        self.assertEqual(parallel.Counts['good'], {36: 2, 0: 2})
+
+    def test_columnar_cache(self):
+        path = write_history()
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{grade} != A')], processes=1)
+        history = LoanHistory.LoanHistory(filters, [path], cache=True)
+        self.assertEqual(history.Counts, {'default': {5: 1, 25: 1}, 'good': {36: 1}})
+
+        cache = HistoryCache.HistoryCache(path)
+        self.assertTrue(cache.is_fresh())
+        batch = cache.load()
+        self.assertEqual(len(batch), 4)
+        self.assertEqual(list(batch.take(np.array([1, 3])).column('id').num), [2, 4])
+
+        # Reused while the file is unchanged, rebuilt once it changes
+        history = LoanHistory.LoanHistory(filters, [path], cache=True)
+        self.assertEqual(history.Counts['default'], {5: 1, 25: 1})
+        with open(path, 'a') as handle:
+            handle.write('"5","Charged Off","Jan-2016","Mar-2016","20.0%","E"\n')
+        self.assertFalse(cache.is_fresh())
+        history = LoanHistory.LoanHistory(filters, [path], cache=True)
+        self.assertEqual(history.Counts['default'], {5: 1, 25: 1, 2: 1})
+
+    def test_cache_keeps_integers_exact(self):
+        path = os.path.join(tempfile.mkdtemp(), 'LoanStats.csv')
+        open(path, 'w').close()
+        big = 2 ** 53 + 1
+        cache = HistoryCache.HistoryCache(path)
+        cache.build([{'id': big, 'rate': 5}, {'id': 2, 'rate': 7.5}, {'id': 3}], block=2)
+        batch = cache.load()
+        self.assertEqual(batch.column('id').num.dtype, np.int64)
+        self.assertEqual(batch.column('id').num.tolist(), [big, 2, 3])
+        self.assertEqual(batch.column('rate').num.tolist(), [5.0, 7.5, 0.0])
+        self.assertEqual(LoanFilter.BasicFilter('{id} == %d' % (big)).mask(batch).tolist(), [True, False, False])
+
+    def test_cached_strings_stay_coded(self):
+        path = os.path.join(tempfile.mkdtemp(), 'LoanStats.csv')
+        open(path, 'w').close()
+        loans = [{'grade': 'B'}, {'grade': 'A'}, {'grade': 3}, {'grade': 'B'}, {'grade': ''}]
+        cache = HistoryCache.HistoryCache(path)
+        cache.build(loans, block=2)
+        col = cache.load().column('grade')
+        expected = ColumnFilter.LoanBatch(loans)
+        for rule in ('{grade} == B', '{grade} != A', '{grade} < B', 'B <= {grade}', '{grade}'):
+            self.assertEqual(LoanFilter.BasicFilter(rule).mask(ColumnFilter.LoanBatch(columns={'grade': col})).tolist(),
+                             LoanFilter.BasicFilter(rule).mask(expected).tolist(), rule)
+        unique, counts = col.text_counts(np.ones(len(col), dtype=bool))
+        self.assertEqual((unique.tolist(), counts.tolist()), (['', 'A', 'B'], [1, 1, 2]))
+        self.assertEqual(col.take([3, 2]).values(), ['B', 3])
+        # Comparisons went through the vocabulary. The strings of every row were never built
+        self.assertIsNone(col._text)
+
+
+BACKTEST_CSV = '''"id","loan_status","issue_d","last_pymnt_d","term","inq_last_6mths","funded_amnt","total_pymnt","total_rec_prncp"
+"1","Charged Off","Jan-2015","Jun-2015"," 36 months","3","1000","300","200"
+"2","Fully Paid","Jan-2015","Jan-2018"," 36 months","0","1000","1200","1000"
+"3","Fully Paid","Jan-2015","Jan-2020"," 60 months","0","1000","1500","1000"
+"4","Charged Off","Feb-2014","Mar-2016"," 36 months","0","1000","600","500"
+'''
+
+
+class BacktestTest(unittest.TestCase):
+    def test_marginal_contribution(self):
+        path = write_history(BACKTEST_CSV)
+        self.assertEqual(Backtest.history_rule('{inqLast6Mths} <= 1'), '{inq_last_6mths} <= 1')
+        for cache in (False, True):
+            res = Backtest.Backtest(['{term} == 36', '{inqLast6Mths} <= 1'], [path], cache=cache).result()
+            self.assertEqual(res['all']['loans'], 4)
+            self.assertEqual(res['selected'], {'loans': 2, 'defaults': 1, 'default_rate': 0.5, 'funded': 2000.0,
+                                               'charged_off_principal': 500.0, 'realized_return': -0.1})
+            self.assertEqual([rule['passed'] for rule in res['rules']], [3, 3])
+            self.assertEqual([rule['without']['loans'] for rule in res['rules']], [3, 3])
+            self.assertEqual(res['rules'][1]['without']['defaults'], 2)
+
+
+class SweepTest(unittest.TestCase):
+    def test_expand_templates(self):
+        self.assertEqual(Sweep.expand_template('{inqLast6Mths} <= [0..2]'),
+                         ['{inqLast6Mths} <= 0', '{inqLast6Mths} <= 1', '{inqLast6Mths} <= 2'])
+        self.assertEqual(Sweep.expand_template('{dti} < [10..20:2.5]')[1:3], ['{dti} < 12.5', '{dti} < 15.0'])
+        self.assertEqual(Sweep.expand_template('{grade} in [C..E]'),
+                         ['C <= {grade} <= C', 'C <= {grade} <= D', 'C <= {grade} <= E',
+                          'D <= {grade} <= D', 'D <= {grade} <= E', 'E <= {grade} <= E'])
+        self.assertEqual(Sweep.expand_template('{term} == [36,60]'), ['{term} == 36', '{term} == 60'])
+
+    def test_sweep_matches_backtest(self):
+        path = write_history(BACKTEST_CSV)
+        templates = ['{term} == [36,60]', '{inqLast6Mths} <= [0..3]']
+        for processes in (1, 2):
+            sweep = Sweep.Sweep(templates, [path], processes=processes, chunksize=3).run()
+            self.assertEqual(len(sweep.results), 8)
+            for res in sweep.results:
+                expected = Backtest.Backtest(res['rules'], [path], cache=True).result()['selected']
+                self.assertEqual(dict((k, res[k]) for k in expected), expected)
+        frontier = sweep.frontier()
+        self.assertEqual(frontier[0]['rules'], ['{term} == 60', '{inqLast6Mths} <= 0'])
+        self.assertEqual(frontier[0]['default_rate'], 0.0)
+        self.assertTrue(all(a['realized_return'] < b['realized_return'] for a, b in zip(frontier, frontier[1:])))
+
+    def test_missing_column_is_logged(self):
+        path = write_history(BACKTEST_CSV)
+        with self.assertLogs('lenderbot.Sweep', level='WARNING') as logs:
+            sweep = Sweep.Sweep(['{dti} < [10,20]'], [path], processes=1).run()
+        self.assertEqual(len(logs.output), 2)
+        self.assertIn('no \'dti\' column', logs.output[0])
+        self.assertTrue(all(res['loans'] == 4 for res in sweep.results))
+
+
+class SketchTest(unittest.TestCase):
+    def test_sketches_merge(self):
+        values = [i % 7 for i in range(3000)] + list(range(1000, 3000))
+        whole = Sketch.ColumnProfile(capacity=8, block=100)
+        parts = [Sketch.ColumnProfile(capacity=8, block=100) for _ in range(3)]
+        for i, value in enumerate(values):
+            whole.add(value)
+            parts[i % 3].add(value)
+        merged = pickle.loads(pickle.dumps(parts[0])).merge(parts[1]).merge(parts[2])
+
+        for profile in (whole, merged):
+            res = profile.result(3)
+            self.assertEqual(res['count'], 5000)
+            # 0 through 6 each appear 428 or 429 times, everything else once
+            self.assertTrue(all(value < 7 and count >= 428 for value, count in res['top']))
+            self.assertAlmostEqual(res['distinct'], 2007, delta=60)
+            self.assertEqual(res['quantiles'][0.5], 5.0)
+            self.assertAlmostEqual(res['quantiles'][0.95], 2750, delta=30)
+        self.assertEqual(whole.distinct.registers, merged.distinct.registers)
+
+    def test_space_saving_error_bounds(self):
+        blocks = [dict((value, 1 + (value * block) % 5) for value in range(block, block + 30)) for block in range(8)]
+        exact = {}
+        merged = Sketch.SpaceSaving(8)
+        streamed = Sketch.SpaceSaving(8)
+        for counts in blocks:
+            merged.update(counts)
+            for value, count in counts.items():
+                exact[value] = exact.get(value, 0) + count
+                streamed.add(value, count)
+        for summary in (merged, streamed):
+            for value, count, error in summary.top(8):
+                self.assertTrue(count - error <= exact[value] <= count, value)
+            # Nothing left out occurred more often than the floor
+            self.assertTrue(all(n <= summary.floor for value, n in exact.items() if value not in summary.counters))
+
+    def test_history_stereotype(self):
+        path = write_history()
+        filters = LoanFilter.FilterSet([LoanFilter.BasicFilter('{id} > 0')], processes=1)
+        self.assertEqual(LoanHistory.LoanHistory(filters, [path]).stereoType(output=False), {})
+        for kw in ({}, {'cache': True}, {'processes': 2, 'chunkBytes': 1}):
+            res = LoanHistory.LoanHistory(filters, [path], stereoColumns=None, **kw).stereoType(output=False)
+            self.assertNotIn('csv_line', res)
+            self.assertEqual(res['loan_status']['top'][0], ('Charged Off', 2))
+            self.assertEqual(res['grade']['distinct'], 4)
+            self.assertEqual(res['int_rate']['count'], 4)
+            self.assertEqual((res['int_rate']['quantiles'][0.05], res['int_rate']['quantiles'][0.95]), (9.0, 18.0))
+
+
+class StubLendingClubHandler(BaseHTTPRequestHandler):
+    'Serves canned LendingClub API responses.'
+
+    responses = {
+        'notes': {'myNotes': [{'loanId': 1, 'noteId': 11}]},
+        'detailednotes': {'myNotes': [{'loanId': 1, 'noteId': 11, 'loanStatus': 'Current',
+                                      'interestRate': 10.0, 'grade': 'B2'}]},
+        'availablecash': {'availableCash': 100.0},
+        'pending': {'transfers': [{'amount': 25}]},
+        'portfolios': {'myPortfolios': [{'portfolioId': 5, 'portfolioName': 'lb'}]},
+        'listing': {'loans': [{'id': 2, 'term': 36}]},
+    }
+
+    def do_GET(self):
+        self.server.requests.append((threading.current_thread().name, self.path))
+        if self.server.barrier is not None:
+            # Only respond once the expected number of requests are in flight at the same time
+            try:
+                self.server.barrier.wait(timeout=10)
+            except threading.BrokenBarrierError:
+                self.send_error(504)
+                return
+        body = json.dumps(self.responses[self.path.split('?')[0].rstrip('/').split('/')[-1]]).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubLendingClub(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubLendingClubHandler)
+        self.requests = []
+        self.barrier = None
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    @property
+    def endpoint_root(self):
+        return 'http://127.0.0.1:%d/api/investor/v1/' % (self.server_address[1])
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+class AsyncInvestorTest(unittest.TestCase):
+    def setUp(self):
+        self.server = StubLendingClub()
+        self.investor = Investor.Investor(1, 'auth', rate=20.0, burst=1, endpoint_root=self.server.endpoint_root)
+
+    def tearDown(self):
+        self.investor.close()
+        self.server.stop()
+
+    def test_concurrent_account_queries(self):
+        slept = []
+        # A clock that never moves, so every wait the rate limiter asks for is recorded
+        self.investor.limiter = RateLimiter.TokenBucket(rate=20.0, burst=1, clock=lambda: 0.0, sleep=slept.append)
+        driver = AsyncInvestor.AsyncInvestor(self.investor)
+
+        async def gather():
+            return await asyncio.gather(driver.get_detailed_notes_owned(),
+                                        driver.get_portfolio('lb'),
+                                        driver.get_cash(),
+                                        driver.get_pending_transfers())
+
+        loop = asyncio.new_event_loop()
+        self.server.barrier = threading.Barrier(4)
+        try:
+            notes, portfolio, cash, xfers = loop.run_until_complete(gather())
+        finally:
+            loop.close()
+            driver.close()
+
+        self.assertEqual(notes[0]['loanStatus'], 'Current')
+        self.assertEqual(portfolio['portfolioId'], 5)
+        self.assertEqual(cash, 100.0)
+        self.assertEqual(xfers, [{'amount': 25}])
+
+        # All four requests were in flight at once, each worker used its own session over the
+        # Investor's connection pool, and every request still went through the shared rate limiter
+        self.assertEqual(len(self.server.requests), 4)
+        self.assertEqual(len(driver.clones), 4)
+        self.assertEqual(len(set(id(clone.session) for clone in driver.clones)), 4)
+        adapter = self.investor.session.get_adapter(self.investor.endpoint_root)
+        self.assertTrue(all(clone.session.get_adapter(clone.endpoint_root) is adapter for clone in driver.clones))
+        self.assertTrue(all(clone.limiter is self.investor.limiter for clone in driver.clones))
+        for wait, expected in zip(sorted(slept), [0.05, 0.1, 0.15]):
+            self.assertAlmostEqual(wait, expected)
+        self.assertEqual(len(slept), 3)
+
+    def test_iterators_and_staged_orders(self):
+        driver = AsyncInvestor.AsyncInvestor(self.investor)
+
+        async def collect():
+            notes = [note async for note in driver.iter_detailed_notes_owned()]
+            order = await driver.stage_order({'portfolioId': 5}, 100.0)
+            return notes, order, await driver.submit_staged_order(order, [{'id': 2}])
+
+        loop = asyncio.new_event_loop()
+        try:
+            notes, order, purchased = loop.run_until_complete(collect())
+        finally:
+            loop.close()
+            driver.close()
+
+        self.assertEqual([note['noteId'] for note in notes], [11])
+        self.assertEqual((order.portfolio_id, order.remaining), (5, 4))
+        # Not in production mode, so nothing is ordered
+        self.assertEqual(purchased, [])
+
+    def test_run_gathers_account_state_concurrently(self):
+        bot = lenderbot.LenderBot.__new__(lenderbot.LenderBot)
+        bot.config_dir = tempfile.mkdtemp()
+        bot.config = {'account': {'portfolio': 'lb', 'min_balance': 0}}
+        bot.logger = logging.getLogger(__name__)
+        bot.filters = LoanFilter.FilterSet()
+        bot.driver = self.investor
+        bot.async_driver = AsyncInvestor.AsyncInvestor(self.investor)
+        bot.snapshot = None
+        bot.my_notes = NoteStore.NoteStore(os.path.join(bot.config_dir, 'notes.db'))
+
+        # The four account queries must be in flight at once. Later requests go straight through.
+        self.server.barrier = threading.Barrier(4, action=lambda: setattr(self.server, 'barrier', None))
+        try:
+            bot.run()
+            bot.run()
+        finally:
+            bot.close()
+
+        paths = [path.split('?')[0] for _, path in self.server.requests]
+        self.assertEqual(paths.count('/api/investor/v1/loans/listing'), 2)
+        self.assertEqual(paths.count('/api/investor/v1/accounts/1/availablecash'), 2)
+        # Worker clones were made once and kept across runs
+        self.assertEqual(len(bot.async_driver.clones), 4)
+
+
 if __name__ == '__main__':
     unittest.main()